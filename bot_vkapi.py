@@ -1,8 +1,10 @@
 # -*- coding: utf-8 -*-
 
 from telegram import Update, ReplyKeyboardMarkup, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.constants import ChatAction
 from telegram.ext import (
     Application,
+    BaseUpdateProcessor,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
@@ -10,16 +12,30 @@ from telegram.ext import (
     filters,
 )
 
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import contextvars
+import functools
+import gzip
+import hashlib
+import io
+import json
 import requests
+import shutil
+import signal
 import sqlite3
+import sys
+import tempfile
+import threading
 import time
+import uuid
 
 # ========== КОНФИГУРАЦИЯ ==========
 import os
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
-if not TELEGRAM_TOKEN:
-    print("❌ Ошибка: TELEGRAM_TOKEN не найден!")
-    exit(1)
 
 SMMLABA_SERVICE_CODE = "vklikebest3"
 SMMLABA_API_URL = "https://smmlaba.com/vkapi/v1/"
@@ -28,12 +44,234 @@ SMMLABA_COUNT = 23
 VK_API_VERSION = "5.131"
 DB_PATH = "vk_posts.db"
 
+# Сервисный ключ приложения VK (необязательно) — читает публичные стены, не расходуя лимиты пользователей
+VK_SERVICE_KEY = os.getenv("VK_SERVICE_KEY")
+VK_AUTH_ERROR_CODE = 5                       # токен недействителен или отозван
+VK_ACCESS_ERROR_CODES = {7, 15, 18, 30, 203}  # стена закрыта/нет доступа для этого токена
+VK_EXECUTE_ERROR_CODES = {12, 13}            # VKScript не скомпилировался / упал при выполнении
+PRIVATE_WALL_RECHECK = 24 * 3600             # через сколько снова пробовать закрытую стену через пул
+# Облегчённое чтение стены: execute возвращает только нужные поля постов, а не тексты/вложения
+VK_LEAN_FETCH = os.getenv("VK_LEAN_FETCH", "1") == "1"
+WALL_LEAN_CODE = (
+    'var r = API.wall.get({"owner_id": %d, "count": 10, "filter": "owner"});'
+    'if (!r) return false;'
+    'return {"count": r.count, "id": r.items@.id, "date": r.items@.date,'
+    ' "is_pinned": r.items@.is_pinned, "marked_as_ads": r.items@.marked_as_ads,'
+    ' "reposts": r.items@.reposts};'
+)
+
+# Telegram ID администраторов через запятую — им доступны /trace_last и /profile
+ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").replace(" ", "").split(",") if x.isdigit()}
+TRACE_BUFFER_SIZE = 50       # сколько последних трейсов проверок держим в памяти
+PROFILE_MAX_SECONDS = 600    # максимальное окно для /profile
+PROFILE_INTERVAL = 0.005     # период сэмплирования профайлера, сек
+
+# Параллельная обработка апдейтов Telegram
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "16"))  # апдейтов разных пользователей одновременно
+HANDLER_TIMEOUT = 180        # дольше этого обработчик прерывается, сек
+BUSY_AFTER = 1.0             # через сколько секунд показывать "печатает...", сек
+
+# Остановка и тёплый перезапуск
+SHUTDOWN_DRAIN_SECONDS = 60  # сколько ждать идущие проверки при остановке, сек
+CHECKPOINT_PATH = os.getenv("CHECKPOINT_PATH", "bot_checkpoint.json")
+PENDING_ORDER_LEASE = 120    # аренда записи журнала заказов, сек (с запасом больше отправки заказа)
+
+# Кассеты трафика к VK/smmlaba (--record / --replay)
+CASSETTE_SECRET_KEYS = {"access_token", "apikey", "username"}  # в кассету не попадают
+
+# Очереди запросов к общим лимитам API
+VK_MIN_INTERVAL = 0.34       # VK: не больше 3 запросов в секунду на один токен
+SMMLABA_MIN_INTERVAL = 0.2   # smmlaba: пауза между запросами одного аккаунта
+LANE_INTERACTIVE = "interactive"   # пользователь ждёт ответа (add_vk, /check)
+LANE_ORDERING = "ordering"         # создание заказов
+LANE_BACKGROUND = "background"     # фоновый опрос
+LANE_WEIGHTS = {LANE_INTERACTIVE: 6, LANE_ORDERING: 3, LANE_BACKGROUND: 1}
+LANE_STARVATION_SECONDS = 5.0      # дольше этого заявка не ждёт — получает слот вне очереди
+
+# Таймауты и "страховочные" (hedged) запросы
+VK_TIMEOUT = 10              # потолок таймаута запроса к VK, сек
+SMMLABA_TIMEOUT = 15         # потолок таймаута запроса к smmlaba, сек
+TIMEOUT_MIN = 2.0            # ниже этого адаптивный таймаут не опускается, сек
+TIMEOUT_P99_FACTOR = 2.0     # адаптивный таймаут = p99 × множитель
+LATENCY_WINDOW = 200         # сколько последних замеров держим на эндпоинт
+LATENCY_MIN_SAMPLES = 20     # пока замеров меньше — таймаут фиксированный, без страховки
+HEDGE_RATIO = 0.1            # страховочных запросов не больше 10% от обычных
+# Только идемпотентные чтения: их можно безопасно продублировать (заказ add — нельзя)
+HEDGE_ENDPOINTS = {"vk:wall.get", "vk:execute", "vk:utils.resolveScreenName", "smmlaba:balance"}
+
+
+# ========== ТРАССИРОВКА И ПРОФИЛИРОВАНИЕ ==========
+
+class Span:
+    """Отрезок трассировки: имя, атрибуты, длительность и вложенные отрезки"""
+    __slots__ = ("name", "attrs", "started_at", "start", "duration", "error", "children")
+
+    def __init__(self, name: str, attrs: dict):
+        self.name = name
+        self.attrs = attrs
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.duration = None
+        self.error = None
+        self.children = []
+
+    def to_dict(self):
+        d = {
+            "name": self.name,
+            "started_at": round(self.started_at, 3),
+            "ms": round((self.duration or 0) * 1000, 2),
+        }
+        if self.attrs:
+            d["attrs"] = self.attrs
+        if self.error:
+            d["error"] = self.error
+        if self.children:
+            d["children"] = [c.to_dict() for c in self.children]
+        return d
+
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+_traces = collections.deque(maxlen=TRACE_BUFFER_SIZE)
+
+
+@contextlib.contextmanager
+def trace_span(name: str, root: bool = False, **attrs):
+    """
+    Записывает отрезок трассировки.
+
+    root=True начинает новый трейс (он попадёт в кольцевой буфер _traces).
+    Дочерний отрезок пишется только если снаружи уже есть активный трейс —
+    иначе это пустой with без накладных расходов.
+    contextvars сами переезжают в asyncio.to_thread, так что вложенность
+    сохраняется и для кода, который крутится в потоках.
+    """
+    parent = _current_span.get()
+    if parent is None and not root:
+        yield None
+        return
+
+    span = Span(name, attrs)
+    token = _current_span.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        span.error = repr(e)
+        raise
+    finally:
+        span.duration = time.perf_counter() - span.start
+        _current_span.reset(token)
+        if parent is None:
+            _traces.append(span)
+        else:
+            parent.children.append(span)
+
+
+def export_traces(count: int = 1):
+    """Последние count трейсов в JSON (новые в конце)"""
+    spans = list(_traces)[-count:]
+    return json.dumps([s.to_dict() for s in spans], ensure_ascii=False, indent=1)
+
+
+def summarize_trace(span: Span):
+    """Сколько времени трейса ушло на каждый вид отрезков (vk_api_call, db, ...)"""
+    totals = collections.Counter()
+    counts = collections.Counter()
+
+    def walk(s):
+        for c in s.children:
+            totals[c.name] += c.duration or 0
+            counts[c.name] += 1
+            walk(c)
+
+    walk(span)
+    return [(name, counts[name], totals[name]) for name in totals]
+
+
+def traced(name: str):
+    """Декоратор: вызов функции становится дочерним отрезком текущего трейса"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _current_span.get() is None:
+                return func(*args, **kwargs)
+            with trace_span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class TracedCursor(sqlite3.Cursor):
+    """Курсор, который пишет каждый execute в текущий трейс (если он есть)"""
+
+    def execute(self, sql, params=()):
+        if _current_span.get() is None:
+            return super().execute(sql, params)
+        with trace_span("db", sql=" ".join(sql.split())[:80]):
+            return super().execute(sql, params)
+
+
+class TracedConnection(sqlite3.Connection):
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
+
+
+def db_connect():
+    """Подключение к БД с трассировкой запросов"""
+    return sqlite3.connect(DB_PATH, factory=TracedConnection)
+
+
+class SamplingProfiler:
+    """
+    Сэмплирующий профайлер: отдельный поток раз в interval снимает стеки всех
+    потоков через sys._current_frames(). Результат — "collapsed stacks"
+    (строка "f1;f2;f3 N"), который понимают flamegraph.pl и speedscope.
+    Пока профайлер не запущен, он ничего не стоит.
+    """
+
+    def __init__(self, interval: float = PROFILE_INTERVAL):
+        self.interval = interval
+        self.samples = collections.Counter()
+        self.started_at = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self.started_at = time.time()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        return "\n".join(f"{stack} {n}" for stack, n in self.samples.most_common())
+
+    def _run(self):
+        me = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            for t in threading.enumerate():
+                names[t.ident] = t.name
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.samples[";".join(reversed(stack))] += 1
+
+
+_profiler = None  # активный SamplingProfiler (одновременно только один)
+
 
 # ========== БАЗА ДАННЫХ ==========
 
 def init_database():
 
-    conn = sqlite3.connect(DB_PATH)
+    conn = db_connect()
     cursor = conn.cursor()
 
     # Таблица ВК-аккаунтов
@@ -62,12 +300,857 @@ def init_database():
     )
     """)
 
+    # История постов: всё, что уже пришло в wall.get (только добавление)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS posts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        account_id INTEGER NOT NULL,             -- vk_accounts.id
+        user_id INTEGER NOT NULL,
+        owner_id INTEGER NOT NULL,
+        post_id INTEGER NOT NULL,
+        post_date INTEGER,                       -- unixtime публикации
+        reposts_count INTEGER DEFAULT 0,
+        is_pinned INTEGER DEFAULT 0,
+        marked_as_ads INTEGER DEFAULT 0,
+        ordered INTEGER DEFAULT 0,               -- 1 если заказ на smmlaba принят
+        skip_reason TEXT,                        -- почему не заказывали (reposts, send_error)
+        seen_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE(account_id, post_id)
+    )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_posts_user ON posts(user_id, seen_at)")
+
+    # Агрегаты для /stats — обновляются инкрементально, без пересчёта по posts
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS account_stats (
+        account_id INTEGER PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        posts_seen INTEGER DEFAULT 0,
+        orders INTEGER DEFAULT 0,
+        last_post_date INTEGER
+    )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_account_stats_user ON account_stats(user_id)")
+
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS daily_stats (
+        user_id INTEGER NOT NULL,
+        day TEXT NOT NULL,                       -- YYYY-MM-DD
+        checks INTEGER DEFAULT 0,
+        orders INTEGER DEFAULT 0,
+        likes_ordered INTEGER DEFAULT 0,         -- расход: сколько лайков заказано
+        skipped_reposts INTEGER DEFAULT 0,       -- пропуски: reposts.count >= 1
+        send_errors INTEGER DEFAULT 0,           -- пропуски: smmlaba вернула ошибку
+        vk_errors INTEGER DEFAULT 0,
+        PRIMARY KEY (user_id, day)
+    )
+    """)
+
+    # Журнал заказов: пост уже "забран" (last_post_id обновлён), а заказ ещё не отправлен.
+    # Запись арендует отправитель (owner до lease_until); если процесс остановится,
+    # не отправив заказ, его дошлёт resume_pending_orders, когда аренда истечёт
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS pending_orders (
+        account_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        post_id TEXT NOT NULL,
+        post_url TEXT NOT NULL,
+        owner TEXT NOT NULL,
+        lease_until REAL NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (account_id, post_id)
+    )
+    """)
+
     conn.commit()
     conn.close()
 
 
+# ========== ИСТОРИЯ ПОСТОВ И СТАТИСТИКА ==========
+
+DAILY_STATS_FIELDS = ("checks", "orders", "likes_ordered", "skipped_reposts", "send_errors", "vk_errors")
+
+
+def record_wall_page(cursor, account_id: int, user_id: int, owner_id: int, items: list):
+    """
+    Складывает в posts все посты со страницы wall.get, которых ещё нет в истории.
+    Счётчик posts_seen в account_stats растёт только на реально новые посты.
+    """
+    new_posts = 0
+    last_date = None
+
+    for post in items:
+        post_id = post.get("id")
+        if not post_id:
+            continue
+
+        reposts = post.get("reposts", {}) or {}
+        cursor.execute(
+            """
+            INSERT OR IGNORE INTO posts
+                (account_id, user_id, owner_id, post_id, post_date, reposts_count, is_pinned, marked_as_ads)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (
+                account_id, user_id, owner_id, post_id, post.get("date"),
+                reposts.get("count", 0) or 0,
+                1 if post.get("is_pinned") == 1 else 0,
+                1 if post.get("marked_as_ads") == 1 else 0,
+            ),
+        )
+        new_posts += cursor.rowcount
+
+        post_date = post.get("date")
+        if post_date and (last_date is None or post_date > last_date):
+            last_date = post_date
+
+    cursor.execute(
+        """
+        INSERT INTO account_stats (account_id, user_id, posts_seen, last_post_date)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(account_id) DO UPDATE SET
+            posts_seen = posts_seen + excluded.posts_seen,
+            last_post_date = MAX(COALESCE(last_post_date, 0), COALESCE(excluded.last_post_date, 0))
+        """,
+        (account_id, user_id, new_posts, last_date),
+    )
+
+
+def mark_post_result(cursor, account_id: int, post_id: str, ordered: bool, skip_reason: str = None):
+    """Запоминает, чем закончилась обработка поста: заказ или причина пропуска"""
+    cursor.execute(
+        "UPDATE posts SET ordered=?, skip_reason=? WHERE account_id=? AND post_id=?",
+        (1 if ordered else 0, skip_reason, account_id, int(post_id)),
+    )
+    if ordered:
+        cursor.execute("UPDATE account_stats SET orders = orders + 1 WHERE account_id=?", (account_id,))
+
+
+def bump_daily_stats(cursor, user_id: int, **deltas):
+    """Прибавляет счётчики за сегодняшний день (checks=1, orders=1 и т.д.)"""
+    fields = [f for f in DAILY_STATS_FIELDS if deltas.get(f)]
+    if not fields:
+        return
+
+    day = time.strftime("%Y-%m-%d")
+    cursor.execute(
+        f"""
+        INSERT INTO daily_stats (user_id, day, {", ".join(fields)})
+        VALUES (?, ?, {", ".join("?" for _ in fields)})
+        ON CONFLICT(user_id, day) DO UPDATE SET
+            {", ".join(f"{f} = {f} + excluded.{f}" for f in fields)}
+        """,
+        (user_id, day, *(deltas[f] for f in fields)),
+    )
+
+
+# ========== ПУЛ ТОКЕНОВ ЧТЕНИЯ ==========
+
+class ReadTokenPool:
+    """
+    Пул токенов для чтения публичных стен сообществ.
+
+    Стену открытого сообщества любой рабочий токен видит одинаково, поэтому
+    чтения раскладываются по всем токенам (и сервисному ключу, если задан),
+    а не упираются в лимит токена конкретного аккаунта.
+
+    • токены — из всех vk_accounts: одинаковые хранятся одной строкой
+      (sys.intern) со счётчиком аккаунтов, токен уходит из пула вместе
+      с последним аккаунтом; обновляется точечно из add_vk / delete_vk_account
+    • выбор — самый давно выданный пулом токен (LRU), чей лимит в
+      REQUEST_SCHEDULER свободен прямо сейчас: планировщик видит весь трафик
+      токена (чтения своим токеном, add_vk, resolveScreenName), а не только пул
+    • токен, вернувший ошибку авторизации, выбрасывается из пула
+    • стены, недоступные чужим токенам, запоминаются как закрытые и
+      читаются токеном своего аккаунта (с перепроверкой раз в PRIVATE_WALL_RECHECK;
+      устаревшие отметки вычищаются)
+    """
+
+    def __init__(self):
+        self._tokens = collections.OrderedDict()  # token -> время последнего чтения (LRU сверху)
+        self._refs = collections.Counter()         # token -> сколько аккаунтов с этим токеном
+        self._private_owners = {}                  # owner_id -> когда стена оказалась закрытой
+        self._evicted_hashes = set()               # хэши выброшенных токенов — для чекпоинта
+        self._lock = threading.Lock()
+        self.picks = 0
+        self.evictions = 0
+        if VK_SERVICE_KEY:
+            self._tokens[VK_SERVICE_KEY] = 0.0
+
+    def __len__(self):
+        return len(self._tokens)
+
+    def load(self):
+        """Заполняет пул токенами из vk_accounts (курсор читается построчно, без fetchall)"""
+        conn = db_connect()
+        cursor = conn.cursor()
+        cursor.execute("SELECT vk_token FROM vk_accounts")
+        for (token,) in cursor:
+            self.add(token)
+        conn.close()
+        return len(self._tokens)
+
+    def add(self, token: str):
+        """Ещё один аккаунт с этим токеном"""
+        token = sys.intern(token)
+        with self._lock:
+            self._refs[token] += 1
+            if self._refs[token] == 1 and token not in self._tokens:
+                self._tokens[token] = 0.0
+                self._tokens.move_to_end(token, last=False)
+
+    def discard(self, token: str):
+        """Аккаунт с этим токеном удалён; токен уходит из пула вместе с последним"""
+        with self._lock:
+            self._refs[token] -= 1
+            if self._refs[token] <= 0:
+                del self._refs[token]
+                if token != VK_SERVICE_KEY:
+                    self._tokens.pop(token, None)
+
+    def evict(self, token: str):
+        """Убирает токен после ошибки авторизации"""
+        with self._lock:
+            if self._tokens.pop(token, None) is not None:
+                self.evictions += 1
+                self._evicted_hashes.add(self._token_hash(token))
+
+    def pick(self):
+        """Токен для чтения или None, если лимиты всех токенов заняты (или пул пуст)"""
+        with self._lock:
+            for token in self._tokens:
+                if not REQUEST_SCHEDULER.is_free(vk_budget_key(token)):
+                    continue
+                self._tokens[token] = time.monotonic()
+                self._tokens.move_to_end(token)
+                self.picks += 1
+                return token
+            return None
+
+    def is_private(self, owner_id: int):
+        with self._lock:
+            marked_at = self._private_owners.get(owner_id)
+            if marked_at is None:
+                return False
+            if time.time() - marked_at < PRIVATE_WALL_RECHECK:
+                return True
+            del self._private_owners[owner_id]  # пора перепроверить
+            return False
+
+    def mark_private(self, owner_id: int):
+        now = time.time()
+        with self._lock:
+            self._private_owners[owner_id] = now
+            expired = [o for o, marked_at in self._private_owners.items() if now - marked_at >= PRIVATE_WALL_RECHECK]
+            for owner in expired:
+                del self._private_owners[owner]
+
+    @staticmethod
+    def _token_hash(token: str):
+        return hashlib.sha256(token.encode("utf-8")).hexdigest()[:16]
+
+    def snapshot(self):
+        """Для чекпоинта: закрытые стены и хэши выброшенных токенов (сами токены на диск не пишем)"""
+        with self._lock:
+            return {
+                "private_walls": {str(k): v for k, v in self._private_owners.items()},
+                "evicted": sorted(self._evicted_hashes),
+            }
+
+    def restore(self, data: dict):
+        with self._lock:
+            now = time.time()
+            for owner_id, marked_at in data.get("private_walls", {}).items():
+                if now - marked_at < PRIVATE_WALL_RECHECK:
+                    self._private_owners[int(owner_id)] = marked_at
+            self._evicted_hashes.update(data.get("evicted", []))
+            for token in [t for t in self._tokens if self._token_hash(t) in self._evicted_hashes]:
+                del self._tokens[token]
+
+
+READ_TOKEN_POOL = ReadTokenPool()
+
+
+# ========== ОЧЕРЕДИ ЗАПРОСОВ С ПРИОРИТЕТАМИ ==========
+
+_current_lane = contextvars.ContextVar("current_lane", default=LANE_INTERACTIVE)
+
+
+@contextlib.contextmanager
+def request_lane(lane: str):
+    """Все запросы к VK/smmlaba внутри блока идут в полосу lane"""
+    token = _current_lane.set(lane)
+    try:
+        yield
+    finally:
+        _current_lane.reset(token)
+
+
+class _Budget:
+    """Состояние одного общего лимита (токен VK или аккаунт smmlaba)"""
+    __slots__ = ("next_free", "queues", "passes", "vtime")
+
+    def __init__(self):
+        self.next_free = 0.0
+        self.queues = {lane: collections.deque() for lane in LANE_WEIGHTS}
+        self.passes = dict.fromkeys(LANE_WEIGHTS, 0.0)
+        self.vtime = 0.0
+
+
+class RequestScheduler:
+    """
+    Очередь с приоритетами перед общими лимитами API.
+
+    Для каждого лимита (ключ — токен VK или аккаунт smmlaba) выдерживается
+    минимальный интервал между запросами. Освободившийся слот получает одна
+    из ожидающих заявок:
+      • заявка, ждущая дольше LANE_STARVATION_SECONDS, — первой (защита от голодания)
+      • иначе полоса с наименьшим "пройденным путём": за каждый выданный слот
+        путь полосы растёт на 1/вес (stride scheduling), так что при полной
+        загрузке слоты делятся в пропорции LANE_WEIGHTS
+
+    Запросы синхронные и идут из потоков, поэтому всё на threading.Condition.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._budgets = {}
+        self._stats = {
+            lane: {"depth": 0, "max_depth": 0, "granted": 0, "wait_total": 0.0, "wait_max": 0.0, "starved": 0}
+            for lane in LANE_WEIGHTS
+        }
+
+    def acquire(self, key: str, min_interval: float, lane: str = None):
+        """Ждёт своей очереди на запрос к лимиту key. Возвращает время ожидания, сек"""
+        lane = lane or _current_lane.get()
+        enqueued_at = time.monotonic()
+        ticket = [enqueued_at]
+
+        with self._cond:
+            budget = self._budgets.get(key)
+            if budget is None:
+                budget = self._budgets[key] = _Budget()
+
+            queue = budget.queues[lane]
+            if not queue:
+                # Простаивавшая полоса не копит "кредит" на будущее
+                budget.passes[lane] = max(budget.passes[lane], budget.vtime)
+            queue.append(ticket)
+
+            stats = self._stats[lane]
+            stats["depth"] += 1
+            stats["max_depth"] = max(stats["max_depth"], stats["depth"])
+            self._cond.notify_all()
+
+            while True:
+                now = time.monotonic()
+                winner, starved = self._pick(budget, now)
+                if winner == lane and budget.queues[lane][0] is ticket:
+                    delay = budget.next_free - now
+                    if delay <= 0:
+                        break
+                    self._cond.wait(delay)
+                else:
+                    self._cond.wait(LANE_STARVATION_SECONDS)
+
+            queue.popleft()
+            budget.next_free = now + min_interval
+            budget.vtime = budget.passes[lane]
+            budget.passes[lane] += 1.0 / LANE_WEIGHTS[lane]
+
+            waited = now - enqueued_at
+            stats["depth"] -= 1
+            stats["granted"] += 1
+            stats["wait_total"] += waited
+            stats["wait_max"] = max(stats["wait_max"], waited)
+            if starved:
+                stats["starved"] += 1
+            self._cond.notify_all()
+
+        return waited
+
+    @staticmethod
+    def _pick(budget: _Budget, now: float):
+        """Какая полоса получает следующий слот: (lane, выдан_ли_по_голоданию)"""
+        oldest_lane = None
+        for lane, queue in budget.queues.items():
+            if queue and now - queue[0][0] >= LANE_STARVATION_SECONDS:
+                if oldest_lane is None or queue[0][0] < budget.queues[oldest_lane][0][0]:
+                    oldest_lane = lane
+        if oldest_lane is not None:
+            return oldest_lane, True
+
+        best = None
+        for lane, queue in budget.queues.items():  # порядок = приоритет при равенстве
+            if queue and (best is None or budget.passes[lane] < budget.passes[best]):
+                best = lane
+        return best, False
+
+    def is_free(self, key: str):
+        """Лимит key свободен прямо сейчас: интервал выдержан и очереди нет"""
+        with self._cond:
+            budget = self._budgets.get(key)
+            if budget is None:
+                return True
+            return budget.next_free <= time.monotonic() and not any(budget.queues.values())
+
+    def try_acquire(self, key: str, min_interval: float, lane: str = None):
+        """
+        Слот без ожидания: выдаётся, только если лимит key свободен прямо сейчас
+        и никто не стоит в очереди. Для страховочных запросов — они не должны
+        ни превышать лимит, ни отнимать место у тех, кто ждёт.
+        """
+        lane = lane or _current_lane.get()
+        with self._cond:
+            budget = self._budgets.get(key)
+            now = time.monotonic()
+            if budget is not None:
+                if budget.next_free > now or any(budget.queues.values()):
+                    return False
+                budget.next_free = now + min_interval
+            else:
+                budget = self._budgets[key] = _Budget()
+                budget.next_free = now + min_interval
+            self._stats[lane]["granted"] += 1
+            return True
+
+    def metrics(self):
+        """Снимок метрик по полосам: глубина очереди, выдано слотов, ожидание"""
+        with self._cond:
+            result = {}
+            for lane, st in self._stats.items():
+                result[lane] = dict(st)
+                result[lane]["wait_avg"] = st["wait_total"] / st["granted"] if st["granted"] else 0.0
+            result["budgets"] = len(self._budgets)
+            return result
+
+
+REQUEST_SCHEDULER = RequestScheduler()
+
+
+# ========== АДАПТИВНЫЕ ТАЙМАУТЫ И СТРАХОВОЧНЫЕ ЗАПРОСЫ ==========
+
+class LatencyTracker:
+    """
+    Задержки последних LATENCY_WINDOW запросов по каждому эндпоинту ("vk:wall.get", "smmlaba:balance").
+    Из них — адаптивный таймаут (p99 × TIMEOUT_P99_FACTOR) и порог страховочного запроса (p95).
+    """
+
+    def __init__(self):
+        self._samples = collections.defaultdict(lambda: collections.deque(maxlen=LATENCY_WINDOW))
+        self._lock = threading.Lock()
+
+    def observe(self, key: str, seconds: float):
+        with self._lock:
+            self._samples[key].append(seconds)
+
+    def percentile(self, key: str, q: float):
+        """q-квантиль задержки в секундах или None, если замеров пока мало"""
+        with self._lock:
+            samples = self._samples.get(key)
+            if not samples or len(samples) < LATENCY_MIN_SAMPLES:
+                return None
+            ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def timeout_for(self, key: str, ceiling: float):
+        p99 = self.percentile(key, 0.99)
+        if p99 is None:
+            return ceiling
+        return min(ceiling, max(TIMEOUT_MIN, p99 * TIMEOUT_P99_FACTOR))
+
+    def snapshot(self):
+        with self._lock:
+            return {key: list(samples) for key, samples in self._samples.items()}
+
+    def restore(self, data: dict):
+        with self._lock:
+            for key, samples in data.items():
+                self._samples[key].extend(samples)
+
+
+class HedgeBudget:
+    """
+    Бюджет страховочных запросов (token bucket): каждый обычный запрос добавляет
+    HEDGE_RATIO жетона, страховка тратит один. Так страховок не больше ~10% трафика.
+    """
+
+    def __init__(self, ratio: float = HEDGE_RATIO, burst: float = 5.0):
+        self.ratio = ratio
+        self.burst = burst
+        self.tokens = 0.0
+        self.sent = 0
+        self.won = 0
+        self.denied = 0
+        self._lock = threading.Lock()
+
+    def earn(self):
+        with self._lock:
+            self.tokens = min(self.burst, self.tokens + self.ratio)
+
+    def available(self):
+        """Есть ли жетон на страховку (без списания)"""
+        return self.tokens >= 1.0
+
+    def try_spend(self):
+        with self._lock:
+            if self.tokens >= 1.0:
+                self.tokens -= 1.0
+                self.sent += 1
+                return True
+            self.denied += 1
+            return False
+
+    def refund(self):
+        """Жетон не пригодился (не нашлось свободного слота лимита)"""
+        with self._lock:
+            self.tokens += 1.0
+            self.sent -= 1
+            self.denied += 1
+
+
+LATENCY = LatencyTracker()
+HEDGE_BUDGET = HedgeBudget()
+HEDGE_POOL_SIZE = 16
+_hedge_pool = concurrent.futures.ThreadPoolExecutor(max_workers=HEDGE_POOL_SIZE, thread_name_prefix="hedge")
+# Свободные потоки пула: запрос уходит в пул, только если поток есть — в очереди пула не ждём
+_hedge_workers = threading.BoundedSemaphore(HEDGE_POOL_SIZE)
+
+
+def _submit_to_hedge_pool(do_request):
+    """
+    Запускает do_request() в свободном потоке пула: (future, started) или None,
+    если свободных потоков нет (или пул уже закрыт — бот останавливается).
+    started взводится, когда запрос реально начался.
+    """
+    if not _hedge_workers.acquire(blocking=False):
+        return None
+    started = threading.Event()
+
+    def run():
+        started.set()
+        try:
+            return do_request()
+        finally:
+            _hedge_workers.release()
+
+    try:
+        # copy_context — чтобы отрезки трейса из потоков попали в текущий трейс
+        return _hedge_pool.submit(contextvars.copy_context().run, run), started
+    except RuntimeError:
+        _hedge_workers.release()
+        return None
+
+
+def _succeeded(future):
+    """Запрос завершился ответом, а не ошибкой: (response, None)"""
+    return future.exception() is None and future.result()[1] is None
+
+
+def hedged_request(key: str, do_request, budget_key: str, min_interval: float):
+    """
+    Выполняет do_request(); для идемпотентных чтений (HEDGE_ENDPOINTS) — со страховкой:
+    если ответа нет дольше p95 задержки, отправляем дубль и берём первый успешный ответ.
+    Дубль уходит только при наличии бюджета (HedgeBudget) и свободного слота лимита
+    (REQUEST_SCHEDULER.try_acquire) — лимиты API страховка не нарушает.
+
+    Основной запрос уходит в пул потоков, только когда страховка вообще возможна
+    (есть жетон и свободный поток); иначе выполняется прямо в вызывающем потоке.
+    p95 отсчитывается от реального начала запроса, а не от постановки в пул.
+    """
+    HEDGE_BUDGET.earn()
+    if key not in HEDGE_ENDPOINTS:
+        return do_request()
+
+    hedge_after = LATENCY.percentile(key, 0.95)
+    if hedge_after is None or not HEDGE_BUDGET.available():
+        return do_request()
+
+    submitted = _submit_to_hedge_pool(do_request)
+    if submitted is None:
+        return do_request()
+    primary, started = submitted
+
+    started.wait()
+    try:
+        return primary.result(timeout=hedge_after)
+    except concurrent.futures.TimeoutError:
+        pass
+
+    if not HEDGE_BUDGET.try_spend():
+        return primary.result()
+    if not REQUEST_SCHEDULER.try_acquire(budget_key, min_interval):
+        HEDGE_BUDGET.refund()
+        return primary.result()
+    submitted = _submit_to_hedge_pool(do_request)
+    if submitted is None:
+        HEDGE_BUDGET.refund()
+        return primary.result()
+    hedge, _ = submitted
+
+    # Первый успешный ответ; ошибка (например, оборванный адаптивным таймаутом
+    # запрос) побеждает, только если второй запрос тоже закончился ошибкой
+    pending = {primary, hedge}
+    while pending:
+        done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in (primary, hedge):
+            if future in done and _succeeded(future):
+                if future is hedge:
+                    HEDGE_BUDGET.won += 1
+                return future.result()
+    return primary.result()
+
+
+# ========== ЗАПИСЬ И ВОСПРОИЗВЕДЕНИЕ ТРАФИКА ==========
+
+def redact_params(params: dict):
+    """Параметры запроса без токенов, ключей и логинов"""
+    return {k: v for k, v in params.items() if k not in CASSETTE_SECRET_KEYS}
+
+
+class TrafficCassette:
+    """
+    Кассета с трафиком к VK и smmlaba: gzip JSON Lines.
+    Первая строка — заголовок {"cassette": 1, "workload": {...}}, дальше по строке на запрос:
+    {"api", "method", "params" (без секретов), "result" [ответ, ошибка], "t" (сдвиг от начала, с), "ms"}
+
+    mode="record" — запросы идут в сеть и записываются,
+    mode="replay" — запросы в сеть не идут: ответ берётся из кассеты
+    (первая ещё не выданная запись с тем же api/method/params, иначе — с тем же api/method)
+    и отдаётся с исходной задержкой, умноженной на scale.
+    """
+
+    def __init__(self, mode: str, entries: list = None, header: dict = None, scale: float = 1.0):
+        self.mode = mode
+        self.header = header or {"cassette": 1}
+        self.entries = entries if entries is not None else []
+        self.scale = scale
+        self.started = time.perf_counter()
+        self.calls = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._by_params = collections.defaultdict(collections.deque)
+        self._by_method = collections.defaultdict(collections.deque)
+        for entry in self.entries:
+            self._by_params[self._key(entry["api"], entry["method"], entry["params"])].append(entry)
+            self._by_method[(entry["api"], entry["method"])].append(entry)
+
+    @staticmethod
+    def _key(api, method, params):
+        return api, method, json.dumps(params, sort_keys=True, ensure_ascii=False, default=str)
+
+    @classmethod
+    def load(cls, path: str, scale: float = 1.0):
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            header = json.loads(f.readline())
+            entries = [json.loads(line) for line in f if line.strip()]
+        return cls("replay", entries, header, scale)
+
+    def save(self, path: str):
+        with gzip.open(path, "wt", encoding="utf-8") as f:
+            f.write(json.dumps(self.header, ensure_ascii=False) + "\n")
+            for entry in self.entries:
+                f.write(json.dumps(entry, ensure_ascii=False, separators=(",", ":"), default=str) + "\n")
+
+    def record(self, api, method, params, result, duration):
+        entry = {
+            "api": api,
+            "method": method,
+            "params": redact_params(params),
+            "result": list(result),
+            "t": round(time.perf_counter() - self.started - duration, 4),
+            "ms": round(duration * 1000, 2),
+        }
+        with self._lock:
+            self.calls += 1
+            self.entries.append(entry)
+
+    def replay(self, api, method, params):
+        with self._lock:
+            self.calls += 1
+            entry = None
+            queue = self._by_params.get(self._key(api, method, redact_params(params)))
+            while queue and entry is None:
+                candidate = queue.popleft()
+                if not candidate.get("_used"):
+                    entry = candidate
+            queue = self._by_method.get((api, method))
+            while queue and entry is None:
+                candidate = queue.popleft()
+                if not candidate.get("_used"):
+                    entry = candidate
+            if entry is None:
+                self.misses += 1
+            else:
+                entry["_used"] = True
+
+        if entry is None:
+            error = "Запроса нет в кассете"
+            return None, ({"error_msg": error} if api == "vk" else error)
+
+        time.sleep(entry["ms"] / 1000 * self.scale)
+        response, error = entry["result"]
+        return response, error
+
+    def network_seconds(self):
+        return sum(e["ms"] for e in self.entries) / 1000
+
+
+_cassette = None  # включается только в --record / --replay
+
+
+def traffic_call(api: str, method: str, params: dict, do_request):
+    """
+    Точка, через которую идут все запросы к VK и smmlaba.
+    Без кассеты просто вызывает do_request(); с кассетой — записывает или воспроизводит.
+    """
+    cassette = _cassette
+    if cassette is None:
+        return do_request()
+    if cassette.mode == "replay":
+        return cassette.replay(api, method, params)
+
+    started = time.perf_counter()
+    result = do_request()
+    cassette.record(api, method, params, result, time.perf_counter() - started)
+    return result
+
+
+CASSETTE_DB_TABLES = (
+    "vk_accounts", "user_smmlaba_credentials", "posts",
+    "account_stats", "daily_stats", "pending_orders",
+)
+
+
+def write_db_snapshot(path: str, user_id: int):
+    """
+    Снимок БД для кассеты: только строки пользователя user_id, а токены ВК и
+    ключи smmlaba заменены заглушками (одинаковые токены — одинаковыми заглушками,
+    чтобы лимиты на токен при воспроизведении были те же).
+    Чистим рабочую копию во временной папке и пишем её через VACUUM INTO —
+    удалённые строки не остаются в свободных страницах файла.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        work_path = os.path.join(tmp, "snapshot.db")
+        shutil.copyfile(DB_PATH, work_path)
+        conn = sqlite3.connect(work_path)
+        cursor = conn.cursor()
+
+        for table in CASSETTE_DB_TABLES:
+            cursor.execute(f"DELETE FROM {table} WHERE user_id != ?", (user_id,))
+
+        cursor.execute("SELECT DISTINCT vk_token FROM vk_accounts")
+        for n, (token,) in enumerate(cursor.fetchall(), 1):
+            cursor.execute("UPDATE vk_accounts SET vk_token=? WHERE vk_token=?", (f"redacted-token-{n}", token))
+        cursor.execute("UPDATE user_smmlaba_credentials SET email='redacted@example.com', api_key='redacted'")
+        conn.commit()
+
+        if os.path.exists(path):
+            os.remove(path)
+        cursor.execute("VACUUM INTO ?", (path,))
+        conn.close()
+
+
+def record_workload(cassette_path: str, user_id: int):
+    """
+    Записывает кассету для регресс-теста: одна живая проверка run_check(user_id).
+    Рядом кладётся снимок БД до проверки (CASSETTE.db, без чужих строк и секретов),
+    чтобы воспроизведение стартовало из того же состояния.
+    """
+    global _cassette
+
+    init_database()
+    write_db_snapshot(cassette_path + ".db", user_id)
+    READ_TOKEN_POOL.load()
+
+    _cassette = TrafficCassette("record")
+    started = time.perf_counter()
+    result = run_check(user_id)
+    wall = time.perf_counter() - started
+
+    _cassette.header["workload"] = {
+        "user_id": user_id,
+        "requests": _cassette.calls,
+        "wall_s": round(wall, 3),
+        "network_s": round(_cassette.network_seconds(), 3),
+        "recorded_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    _cassette.save(cassette_path)
+    print(result)
+    print(f"📼 Записано {_cassette.calls} запросов за {wall:.2f} с → {cassette_path}")
+
+
+def replay_workload(cassette_path: str, scale: float = 1.0, max_slowdown: float = 1.2):
+    """
+    Регресс-тест производительности: прогоняет run_check на копии снимка БД,
+    отвечая на запросы из кассеты. Возвращает False (и печатает почему), если
+    запросов стало больше или проверка стала дольше записанной больше чем в max_slowdown раз.
+
+    scale сжимает время целиком: и задержки ответов, и паузы лимитов API,
+    поэтому ожидаемое время — записанное, умноженное на scale.
+    """
+    global _cassette, DB_PATH, VK_MIN_INTERVAL, SMMLABA_MIN_INTERVAL, REQUEST_SCHEDULER
+
+    _cassette = TrafficCassette.load(cassette_path, scale)
+    workload = _cassette.header["workload"]
+    VK_MIN_INTERVAL *= scale
+    SMMLABA_MIN_INTERVAL *= scale
+    REQUEST_SCHEDULER = RequestScheduler()  # паузы лимитов — с чистого листа, как при записи
+
+    with tempfile.TemporaryDirectory() as tmp:
+        DB_PATH = os.path.join(tmp, "replay.db")
+        shutil.copyfile(cassette_path + ".db", DB_PATH)
+        init_database()
+        READ_TOKEN_POOL.load()
+
+        started = time.perf_counter()
+        run_check(workload["user_id"])
+        wall = time.perf_counter() - started
+
+    expected = workload["wall_s"] * scale
+    print(f"📼 Запросов: {_cassette.calls} (было {workload['requests']}), промахов кассеты: {_cassette.misses}")
+    print(f"⏱️ Время: {wall:.2f} с (ожидалось ~{expected:.2f} с, допуск x{max_slowdown})")
+
+    ok = True
+    if _cassette.calls > workload["requests"]:
+        print("❌ Регрессия: запросов к API стало больше")
+        ok = False
+    if wall > expected * max_slowdown + 0.1:
+        print("❌ Регрессия: проверка стала медленнее")
+        ok = False
+    if ok:
+        print("✅ Регрессий нет")
+    return ok
+
+
+# ========== РАЗМЕР ОТВЕТОВ API ==========
+
+# "vk:wall.get" -> [запросов, байт, секунд на разбор JSON]
+PAYLOAD_STATS = collections.defaultdict(lambda: [0, 0, 0.0])
+_payload_lock = threading.Lock()
+
+
+def account_payload(key: str, nbytes: int, parse_seconds: float):
+    """Учитывает размер ответа и время его разбора (и пишет их в текущий отрезок трейса)"""
+    with _payload_lock:
+        st = PAYLOAD_STATS[key]
+        st[0] += 1
+        st[1] += nbytes
+        st[2] += parse_seconds
+
+    span = _current_span.get()
+    if span is not None:
+        span.attrs["bytes"] = nbytes
+        span.attrs["parse_ms"] = round(parse_seconds * 1000, 3)
+
+
 # ========== VK API ФУНКЦИИ ==========
 
+def vk_budget_key(access_token: str):
+    """Ключ лимита токена в REQUEST_SCHEDULER"""
+    return "vk:" + access_token
+
+
 def vk_api_call(method: str, params: dict, access_token: str):
     """
     Универсальный вызов VK API.
@@ -86,14 +1169,43 @@ def vk_api_call(method: str, params: dict, access_token: str):
     p["access_token"] = access_token
     p["v"] = VK_API_VERSION
 
+    budget_key = vk_budget_key(access_token)
+
+    with trace_span("vk_api_call", method=method) as span:
+        waited = REQUEST_SCHEDULER.acquire(budget_key, VK_MIN_INTERVAL)
+        if span:
+            span.attrs["queue_ms"] = round(waited * 1000, 2)
+
+        resp, err = traffic_call(
+            "vk", method, p,
+            lambda: hedged_request("vk:" + method, lambda: _vk_http_get(url, p), budget_key, VK_MIN_INTERVAL),
+        )
+        if err and span:
+            span.error = err.get("error_msg")
+        return resp, err
+
+
+def _vk_http_get(url: str, p: dict):
+    """Сам HTTP-запрос к VK API: (response, None) или (None, error_dict)"""
+    key = "vk:" + url.rsplit("/", 1)[-1]
     try:
-        r = requests.get(url, params=p, timeout=10)
+        started = time.perf_counter()
+        try:
+            r = requests.get(url, params=p, timeout=LATENCY.timeout_for(key, VK_TIMEOUT))
+        finally:
+            LATENCY.observe(key, time.perf_counter() - started)
         r.encoding = "utf-8"
+        parse_started = time.perf_counter()
         data = r.json()
+        account_payload(key, len(r.content), time.perf_counter() - parse_started)
 
         if "error" in data:
             return None, data["error"]
 
+        # execute: вложенный вызов упал — скрипт вернул false, сама ошибка лежит в execute_errors
+        if data.get("response") is False and data.get("execute_errors"):
+            return None, data["execute_errors"][0]
+
         return data.get("response"), None
     except Exception as e:
         return None, {"error_msg": str(e)}
@@ -146,12 +1258,77 @@ def resolve_owner_id(vk_input: str, access_token: str):
          return None, f"Неизвестный тип объекта: {obj_type}"
 
 
-def get_last_vk_post(owner_id: int, access_token: str):
+def vk_wall_read(owner_id: int, access_token: str, read):
     """
-    Возвращает: post_url, post_id, skip_send, error
-    skip_send=True если репостов >=1 (не отправлять в smmlaba)
+    Чтение стены через пул токенов (READ_TOKEN_POOL).
+    read(token) делает сам запрос и возвращает (response, error_dict).
+
+    Публичная стена сообщества читается любым свободным токеном пула; если он не
+    подошёл (ошибка авторизации — токен выкидывается из пула, нет доступа — стена
+    помечается закрытой), повторяем токеном самого аккаунта.
+    Закрытые стены и стены пользователей сразу читаются токеном аккаунта: на стене
+    профиля чужой токен может не увидеть посты "только для друзей", и последний
+    пост у разных токенов окажется разным.
     """
-    resp, err = vk_api_call(
+    if owner_id > 0 or READ_TOKEN_POOL.is_private(owner_id):
+        return read(access_token)
+
+    token = READ_TOKEN_POOL.pick()
+    if token is None or token == access_token:
+        return read(access_token)
+
+    resp, err = read(token)
+    if not err:
+        return resp, None
+
+    code = err.get("error_code")
+    if code == VK_AUTH_ERROR_CODE:
+        READ_TOKEN_POOL.evict(token)
+    elif code in VK_ACCESS_ERROR_CODES:
+        READ_TOKEN_POOL.mark_private(owner_id)
+    else:
+        return None, err
+
+    return read(access_token)
+
+
+def _unpack_lean_page(resp):
+    """Собирает посты из колонок, которые вернул WALL_LEAN_CODE (None — ответ не тот)"""
+    if not isinstance(resp, dict) or not isinstance(resp.get("id"), list):
+        return None
+
+    items = []
+    for i, post_id in enumerate(resp["id"]):
+        post = {"id": post_id}
+        for field in ("date", "is_pinned", "marked_as_ads", "reposts"):
+            column = resp.get(field)
+            if isinstance(column, list) and i < len(column) and column[i] is not None:
+                post[field] = column[i]
+        items.append(post)
+    return {"count": resp.get("count"), "items": items}
+
+
+def fetch_wall_page(owner_id: int, access_token: str):
+    """
+    Последние 10 постов стены: (response, error_dict), response = {"count", "items"}.
+
+    В облегчённом режиме (VK_LEAN_FETCH) стена читается через execute, который
+    отдаёт только id/date/is_pinned/marked_as_ads/reposts — без текстов, вложений
+    и copy_history. Ошибку самого wall.get (нет доступа, токен отозван) execute
+    отдаёт как есть — повторно стену не читаем. Обычным wall.get читаем, только
+    если не сработал сам VKScript, ответ оказался не тем или токен — сервисный
+    ключ, которому execute недоступен.
+    """
+    if VK_LEAN_FETCH and access_token != VK_SERVICE_KEY:
+        resp, err = vk_api_call("execute", {"code": WALL_LEAN_CODE % owner_id}, access_token)
+        if err and err.get("error_code") not in VK_EXECUTE_ERROR_CODES:
+            return None, err
+        if not err:
+            lean = _unpack_lean_page(resp)
+            if lean is not None:
+                return lean, None
+
+    return vk_api_call(
         "wall.get",
         {
             "owner_id": owner_id,
@@ -161,6 +1338,21 @@ def get_last_vk_post(owner_id: int, access_token: str):
         access_token
     )
 
+
+def get_last_vk_post(owner_id: int, access_token: str, page: list = None, use_pool: bool = True):
+    """
+    Возвращает: post_url, post_id, skip_send, error
+    skip_send=True если репостов >=1 (не отправлять в smmlaba)
+
+    Если передан список page — в него складываются все посты со страницы
+    (для истории постов, чтобы не делать лишних запросов).
+    use_pool=False — читать строго токеном аккаунта (например, чтобы проверить сам токен).
+    """
+    if use_pool:
+        resp, err = vk_wall_read(owner_id, access_token, functools.partial(fetch_wall_page, owner_id))
+    else:
+        resp, err = fetch_wall_page(owner_id, access_token)
+
     if err:
         return None, None, False, err.get("error_msg", "Ошибка VK API")
 
@@ -168,6 +1360,8 @@ def get_last_vk_post(owner_id: int, access_token: str):
         return None, None, False, "Неожиданный формат ответа VK API"
 
     items = resp.get("items", [])
+    if page is not None:
+        page.extend(items)
     if not items:
         return None, None, False, None  # постов нет
 
@@ -198,12 +1392,37 @@ def get_last_vk_post(owner_id: int, access_token: str):
     return post_url, str(post_id), skip_send, None
 
 
+def is_newer_post(post_id, last_post_id):
+    """
+    Курсор стены двигается только вперёд: id постов на стене растут, поэтому
+    пост с id не больше сохранённого — не новый (удалили свежий пост, другой токен
+    видит стену иначе и т.п.), заказывать его нельзя.
+    """
+    if not last_post_id:
+        return True
+    return int(post_id) > int(last_post_id)
+
+
 # ========== SMMLABA API ФУНКЦИИ ==========
 def smmlaba_request(data: dict):
     """
     Универсальная функция для запросов к SMMLaba.
     Возвращает (json_dict, None) или (None, текст_ошибки).
+
+    Запросы одного аккаунта smmlaba идут через очередь с приоритетами
+    (полоса берётся из request_lane, заказы — LANE_ORDERING).
     """
+    budget_key = "smm:" + str(data.get("username", ""))
+    action = str(data.get("action", ""))
+    REQUEST_SCHEDULER.acquire(budget_key, SMMLABA_MIN_INTERVAL)
+    return traffic_call(
+        "smmlaba", action, data,
+        lambda: hedged_request("smmlaba:" + action, lambda: _smmlaba_http_post(data), budget_key, SMMLABA_MIN_INTERVAL),
+    )
+
+
+def _smmlaba_http_post(data: dict):
+    """Сам HTTP-запрос к SMMLaba: (json_dict, None) или (None, текст_ошибки)"""
 
     # Заголовки для запроса.
     # Accept просит сервер отвечать JSON (если он умеет).
@@ -213,10 +1432,20 @@ def smmlaba_request(data: dict):
         "User-Agent": "Mozilla/5.0 (TelegramBot; +https://t.me/)"
     }
 
+    key = "smmlaba:" + str(data.get("action", ""))
+    # Таймаут подстраивается только под идемпотентные запросы: заказ, оборванный
+    # слишком рано, мог пройти на стороне smmlaba, а мы сочли бы его ошибкой
+    timeout = LATENCY.timeout_for(key, SMMLABA_TIMEOUT) if key in HEDGE_ENDPOINTS else SMMLABA_TIMEOUT
+
     try:
         # Отправляем POST-запрос на SMMLaba.
         # data=... означает "отправить как form-urlencoded" (обычный формат для SMM API).
-        r = requests.post(SMMLABA_API_URL, data=data, headers=headers, timeout=15)
+        started = time.perf_counter()
+        try:
+            r = requests.post(SMMLABA_API_URL, data=data, headers=headers, timeout=timeout)
+        finally:
+            LATENCY.observe(key, time.perf_counter() - started)
+        r.encoding = "utf-8"
 
         # Берем ответ как текст, чтобы в случае ошибки показать первые символы.
         text = (r.text or "").strip()
@@ -228,7 +1457,10 @@ def smmlaba_request(data: dict):
 
         # Пробуем разобрать ответ как JSON.
         try:
-            return r.json(), None
+            parse_started = time.perf_counter()
+            result = r.json()
+            account_payload(key, len(r.content), time.perf_counter() - parse_started)
+            return result, None
         except ValueError:
             # Если это не JSON — вернём кусок ответа, чтобы понять, что пришло.
             return None, f"Ответ API не JSON. Ответ: {text[:250]}"
@@ -238,8 +1470,7 @@ def smmlaba_request(data: dict):
         return None, f"Ошибка соединения: {e}"
 
 
-
-
+@traced("smmlaba.balance")
 def check_smmlaba_balance(email: str, api_key: str):
     """
     Проверяет баланс на smmlaba по их API-инструкции.
@@ -256,44 +1487,26 @@ def check_smmlaba_balance(email: str, api_key: str):
         "action": "balance",
     }
 
-    # Заголовки. Accept просит JSON, User-Agent делает запрос "похожим на браузер".
-    headers = {
-        "Accept": "application/json",
-        "User-Agent": "Mozilla/5.0",
-    }
-
-    try:
-        # Отправляем POST на правильный URL smmlaba.
-        r = requests.post(SMMLABA_API_URL, data=data, headers=headers, timeout=15)
-        r.encoding = "utf-8"
-
-        # Если сервер вернул не 200 — это ошибка уровня HTTP.
-        if r.status_code != 200:
-            return None, f"HTTP ошибка: {r.status_code}. Ответ: {(r.text or '')[:200]}"
-
-        # Пытаемся распарсить JSON.
-        try:
-            result = r.json()
-        except ValueError:
-            return None, f"Ответ API не JSON. Ответ: {(r.text or '')[:200]}"
+    # HTTP, сеть и разбор JSON — в smmlaba_request (там же очередь запросов)
+    result, error = smmlaba_request(data)
+    if error:
+        return None, error
 
-        # По инструкции: result = success/error
-        if result.get("result") != "success":
-            return None, result.get("error", "Неизвестная ошибка API")
+    # По инструкции: result = success/error
+    if result.get("result") != "success":
+        return None, result.get("error", "Неизвестная ошибка API")
 
-        # При success полезные данные лежат в поле message
-        message = result.get("message", {})
+    # При success полезные данные лежат в поле message
+    message = result.get("message", {})
 
-        # В message для balance должно быть поле balance
-        try:
-            balance = float(message.get("balance", 0))
-            return balance, None
-        except (TypeError, ValueError):
-            return None, f"Не удалось прочитать balance из ответа: {message}"
-
-    except Exception as e:
-        return None, f"Ошибка запроса: {e}"
+    # В message для balance должно быть поле balance
+    try:
+        balance = float(message.get("balance", 0))
+        return balance, None
+    except (TypeError, ValueError, AttributeError):
+        return None, f"Не удалось прочитать balance из ответа: {message}"
 
+@traced("send_to_smmlaba")
 def send_to_smmlaba(post_url: str, email: str, api_key: str):
     """
     Создаёт заказ на smmlaba по их API-инструкции.
@@ -309,30 +1522,16 @@ def send_to_smmlaba(post_url: str, email: str, api_key: str):
         "count": SMMLABA_COUNT,
     }
 
-    headers = {
-        "Accept": "application/json",
-        "User-Agent": "Mozilla/5.0",
-    }
-
-    try:
-        r = requests.post(SMMLABA_API_URL, data=data, headers=headers, timeout=15)
-        r.encoding = "utf-8"
-
-        if r.status_code != 200:
-            return False, f"HTTP ошибка: {r.status_code}. Ответ: {(r.text or '')[:200]}"
-
-        try:
-            result = r.json()
-        except ValueError:
-            return False, f"Ответ API не JSON. Ответ: {(r.text or '')[:200]}"
+    # Заказы идут своей полосой: не отбирают слоты у пользователя, ждущего ответа
+    with request_lane(LANE_ORDERING):
+        result, error = smmlaba_request(data)
+    if error:
+        return False, error
 
-        if result.get("result") == "success":
-            return True, result.get("message", "Заказ принят")
+    if result.get("result") == "success":
+        return True, result.get("message", "Заказ принят")
 
-        return False, result.get("error", "Неизвестная ошибка API")
-
-    except Exception as e:
-        return False, f"Ошибка запроса: {e}"
+    return False, result.get("error", "Неизвестная ошибка API")
 
 # ========== КЛАВИАТУРЫ ==========
 
@@ -389,6 +1588,9 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "Проверяет все добавленные аккаунты и загружает новые посты\n\n"
         "4️⃣ ПОКАЗАТЬ СПИСОК АККАУНТОВ:\n"
         "/list\n\n"
+        "5️⃣ СТАТИСТИКА:\n"
+        "/stats\n"
+        "Посты по аккаунтам, заказы по дням, расход и пропуски\n\n"
         "🔐 КАК ПОЛУЧИТЬ USER TOKEN VK:\n"
         "1. Откройте URL: https://oauth.vk.com/authorize?client_id=2685278&scope=wall,groups,offline&redirect_uri=https://oauth.vk.com/blank.html&display=page&response_type=token&v=5.131\n"
         "2. Нажмите 'Разрешить'\n"
@@ -419,13 +1621,13 @@ async def set_smmlaba_credentials(update: Update, context: ContextTypes.DEFAULT_
     msg = await update.message.reply_text("⏳ Проверяю учётные данные...")
 
     # Проверяем данные через API smmlaba
-    balance, error = check_smmlaba_balance(email, api_key)
+    balance, error = await asyncio.to_thread(check_smmlaba_balance, email, api_key)
     if error:
         await msg.edit_text(f"❌ Ошибка при проверке:\n{error}\n\nУбедитесь, что email и API ключ верны.")
         return
 
     # Сохраняем в БД
-    conn = sqlite3.connect(DB_PATH)
+    conn = db_connect()
     cursor = conn.cursor()
     cursor.execute("SELECT user_id FROM user_smmlaba_credentials WHERE user_id=?", (user_id,))
     exists = cursor.fetchone()
@@ -456,7 +1658,7 @@ async def show_smmlaba_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показывает текущий баланс и учётные данные"""
     user_id = update.effective_user.id
 
-    conn = sqlite3.connect(DB_PATH)
+    conn = db_connect()
     cursor = conn.cursor()
     cursor.execute("SELECT email, api_key FROM user_smmlaba_credentials WHERE user_id=?", (user_id,))
     row = cursor.fetchone()
@@ -472,7 +1674,7 @@ async def show_smmlaba_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
     email, api_key = row
     msg = await update.message.reply_text("⏳ Получаю информацию о балансе...")
 
-    balance, error = check_smmlaba_balance(email, api_key)
+    balance, error = await asyncio.to_thread(check_smmlaba_balance, email, api_key)
 
     if error:
         await msg.edit_text(f"❌ Ошибка: {error}")
@@ -566,7 +1768,7 @@ async def add_vk(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
     # 5. Проверяем лимит 10 аккаунтов
-    conn = sqlite3.connect(DB_PATH)
+    conn = db_connect()
     cursor = conn.cursor()
     cursor.execute("SELECT COUNT(*) FROM vk_accounts WHERE user_id=?", (user_id,))
     count = cursor.fetchone()[0]
@@ -577,14 +1779,18 @@ async def add_vk(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # 6. Получаем owner_id из vk_input (id123, club123, короткое имя и т.п.)
-    owner_id, err = resolve_owner_id(vk_input, vk_token)
+    owner_id, err = await asyncio.to_thread(resolve_owner_id, vk_input, vk_token)
     if err:
         await status.edit_text(f"❌ Ошибка при распознавании VK ID:\n{err}")
         conn.close()
         return
 
     # 7. Проверяем доступ к стене — берём последний пост
-    last_post_url, last_post_id, err = get_last_vk_post(owner_id, vk_token)
+    #    (строго своим токеном — так заодно проверяем, что токен рабочий)
+    page = []
+    last_post_url, last_post_id, _, err = await asyncio.to_thread(
+        get_last_vk_post, owner_id, vk_token, page, use_pool=False
+    )
     if err:
         await status.edit_text(f"❌ Ошибка VK API:\n{err}")
         conn.close()
@@ -610,7 +1816,10 @@ async def add_vk(update: Update, context: ContextTypes.DEFAULT_TYPE):
             """,
             (user_id, vk_input, owner_id, vk_token, last_post_url, last_post_id),
         )
+        acc_id = cursor.lastrowid
+        record_wall_page(cursor, acc_id, user_id, owner_id, page)
         conn.commit()
+        READ_TOKEN_POOL.add(vk_token)
 
         await status.edit_text(
             "✅ ВК аккаунт успешно добавлен!\n\n"
@@ -655,12 +1864,12 @@ async def delete_vk_account(update: Update, context: ContextTypes.DEFAULT_TYPE):
     vk_input = context.args[0].strip().lower()
     
     # Подключаемся к базе данных
-    conn = sqlite3.connect(DB_PATH)
+    conn = db_connect()
     cursor = conn.cursor()
     
     # Ищем такой аккаунт у этого пользователя
     cursor.execute(
-        "SELECT id, vk_input FROM vk_accounts WHERE user_id=? AND vk_input=?",
+        "SELECT id, vk_input, vk_token FROM vk_accounts WHERE user_id=? AND vk_input=?",
         (user_id, vk_input)
     )
     
@@ -677,7 +1886,10 @@ async def delete_vk_account(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Удаляем аккаунт из базы данных
     try:
         cursor.execute("DELETE FROM vk_accounts WHERE id=?", (account[0],))
+        # Неотправленные заказы удалённого аккаунта больше не нужны
+        cursor.execute("DELETE FROM pending_orders WHERE account_id=?", (account[0],))
         conn.commit()
+        READ_TOKEN_POOL.discard(account[2])
         
         await update.message.reply_text(
             f"✅ Аккаунт '{vk_input}' успешно удалён!\\n\\n"
@@ -693,7 +1905,7 @@ async def list_accounts(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показывает список добавленных ВК-аккаунтов"""
     user_id = update.effective_user.id
 
-    conn = sqlite3.connect(DB_PATH)
+    conn = db_connect()
     cursor = conn.cursor()
     cursor.execute(
         "SELECT vk_input, owner_id, last_post_url FROM vk_accounts WHERE user_id=? ORDER BY id",
@@ -717,11 +1929,168 @@ async def list_accounts(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(text)
 
 
-async def check_posts(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Проверяет все ВК-аккаунты на новые посты и загружает их на smmlaba"""
+async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Статистика пользователя по истории постов.
+    Считается только из агрегатов account_stats/daily_stats — без запросов к VK и smmlaba.
+    """
     user_id = update.effective_user.id
+    week_ago = time.strftime("%Y-%m-%d", time.localtime(time.time() - 6 * 86400))
+
+    conn = db_connect()
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        SELECT a.vk_input, COALESCE(s.posts_seen, 0), COALESCE(s.orders, 0)
+        FROM vk_accounts a LEFT JOIN account_stats s ON s.account_id = a.id
+        WHERE a.user_id=? ORDER BY a.id
+        """,
+        (user_id,)
+    )
+    accounts = cursor.fetchall()
+
+    cursor.execute(
+        "SELECT day, orders, likes_ordered FROM daily_stats WHERE user_id=? AND day>=? ORDER BY day",
+        (user_id, week_ago)
+    )
+    days = cursor.fetchall()
+
+    cursor.execute(
+        """
+        SELECT COALESCE(SUM(checks), 0), COALESCE(SUM(orders), 0), COALESCE(SUM(likes_ordered), 0),
+               COALESCE(SUM(skipped_reposts), 0), COALESCE(SUM(send_errors), 0), COALESCE(SUM(vk_errors), 0)
+        FROM daily_stats WHERE user_id=?
+        """,
+        (user_id,)
+    )
+    checks, orders, likes, skipped_reposts, send_errors, vk_errors = cursor.fetchone()
+    conn.close()
 
-    conn = sqlite3.connect(DB_PATH)
+    if not accounts and not checks:
+        await update.message.reply_text(
+            "📊 Статистики пока нет.\n"
+            "Добавьте аккаунт (/add_vk) и запустите проверку (/check)"
+        )
+        return
+
+    text = "📊 СТАТИСТИКА\n\n📋 Посты по аккаунтам (увидено / заказано):\n"
+    for vk_input, posts_seen, acc_orders in accounts:
+        text += f"  • {vk_input}: {posts_seen} / {acc_orders}\n"
+
+    text += "\n📅 Заказы за 7 дней:\n"
+    if days:
+        for day, day_orders, day_likes in days:
+            text += f"  • {day}: {day_orders} заказ(ов), {day_likes} лайков\n"
+    else:
+        text += "  • заказов не было\n"
+
+    text += (
+        f"\n🧾 Всего:\n"
+        f"• Проверок: {checks}\n"
+        f"• Заказов: {orders}\n"
+        f"• Заказано лайков: {likes}\n\n"
+        f"⏭️ Пропуски:\n"
+        f"• Есть репосты (reposts.count >= 1): {skipped_reposts}\n"
+        f"• Ошибка smmlaba: {send_errors}\n"
+        f"• Ошибка VK API: {vk_errors}"
+    )
+
+    await update.message.reply_text(text)
+
+
+# ========== ПРОВЕРКА ПОСТОВ ==========
+
+# Идущие сейчас проверки: user_id -> asyncio.Task.
+# Повторный запрос того же пользователя ждёт уже запущенную проверку, а не стартует новую.
+_inflight_checks = {}
+
+# Бот останавливается: новые проверки не начинаем, идущие не берут новые аккаунты
+SHUTTING_DOWN = threading.Event()
+
+
+def claim_pending_order(cursor, account_id: int, post_id: str, owner: str):
+    """
+    Захват записи журнала перед отправкой заказа: своя запись продлевается,
+    чужая забирается, только если её аренда истекла. True — заказ отправляем мы.
+    """
+    now = time.time()
+    cursor.execute(
+        "UPDATE pending_orders SET owner=?, lease_until=? "
+        "WHERE account_id=? AND post_id=? AND (owner=? OR lease_until < ?)",
+        (owner, now + PENDING_ORDER_LEASE, account_id, post_id, owner, now)
+    )
+    return cursor.rowcount == 1
+
+
+def finish_pending_order(cursor, account_id: int, post_id: str, owner: str):
+    """Убирает свою запись из журнала (в одной транзакции с результатом заказа)"""
+    cursor.execute(
+        "DELETE FROM pending_orders WHERE account_id=? AND post_id=? AND owner=?",
+        (account_id, post_id, owner)
+    )
+
+
+def resume_pending_orders(user_id: int = None):
+    """
+    Досылает заказы из журнала pending_orders, брошенные отправителем (аренда
+    истекла: процесс упал или был убит между захватом поста и заказом).
+    user_id=None — по всем пользователям. Возвращает число принятых заказов.
+
+    Записи, которые сейчас отправляет живая проверка, не трогаем: у них аренда
+    ещё действует, и claim_pending_order их не отдаст.
+    """
+    owner = uuid.uuid4().hex
+    conn = db_connect()
+    cursor = conn.cursor()
+    query = """
+        SELECT p.account_id, p.user_id, p.post_id, p.post_url, c.email, c.api_key
+        FROM pending_orders p
+        JOIN vk_accounts a ON a.id = p.account_id
+        JOIN user_smmlaba_credentials c ON c.user_id = p.user_id
+        WHERE p.lease_until < ?
+    """
+    if user_id is None:
+        cursor.execute(query, (time.time(),))
+    else:
+        cursor.execute(query + " AND p.user_id=?", (time.time(), user_id))
+    pending = cursor.fetchall()
+
+    sent = 0
+    for acc_id, owner_user_id, post_id, post_url, email, api_key in pending:
+        if SHUTTING_DOWN.is_set():
+            break
+
+        claimed = claim_pending_order(cursor, acc_id, post_id, owner)
+        conn.commit()
+        if not claimed:
+            continue
+
+        success, _ = send_to_smmlaba(post_url, email, api_key)
+        finish_pending_order(cursor, acc_id, post_id, owner)
+        if success:
+            sent += 1
+            mark_post_result(cursor, acc_id, post_id, True)
+            bump_daily_stats(cursor, owner_user_id, orders=1, likes_ordered=SMMLABA_COUNT)
+        else:
+            mark_post_result(cursor, acc_id, post_id, False, "send_error")
+            bump_daily_stats(cursor, owner_user_id, send_errors=1)
+        conn.commit()
+
+    conn.close()
+    return sent
+
+
+def run_check(user_id: int):
+    """
+    Проверяет все ВК-аккаунты пользователя на новые посты и загружает их на smmlaba.
+    Блокирующая функция (запросы к VK/smmlaba) — вызывается в отдельном потоке.
+    Возвращает текст итогового сообщения.
+
+    Новый пост "забирается" через compare-and-set по last_post_id: заказ
+    отправляет только тот, чей UPDATE реально сработал — так дубли невозможны
+    даже при параллельных проверках из разных процессов.
+    """
+    conn = db_connect()
     cursor = conn.cursor()
 
     # Получаем учётные данные smmlaba
@@ -730,11 +2099,10 @@ async def check_posts(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if not smm:
         conn.close()
-        await update.message.reply_text(
+        return (
             "❌ Сначала сохраните учётные данные smmlaba!\n"
             "Используйте: /set_smmlaba EMAIL API_KEY"
         )
-        return
 
     email, api_key = smm
 
@@ -742,12 +2110,11 @@ async def check_posts(update: Update, context: ContextTypes.DEFAULT_TYPE):
     balance, error = check_smmlaba_balance(email, api_key)
     if error or balance <= 0:
         conn.close()
-        await update.message.reply_text(
+        return (
             f"❌ Проблема с балансом!\n"
             f"Ошибка: {error if error else 'Баланс = 0'}\n\n"
             f"Пополните баланс на https://smmlaba.com/"
         )
-        return
 
     # Получаем все ВК-аккаунты пользователя
     cursor.execute(
@@ -758,46 +2125,85 @@ async def check_posts(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if not accounts:
         conn.close()
-        await update.message.reply_text(
+        return (
             "❌ Нет добавленных ВК аккаунтов!\n"
             "Добавьте: /add_vk VK_ID VK_TOKEN"
         )
-        return
-
-    msg = await update.message.reply_text(f"⏳ Проверяю посты...\n💰 Баланс: {balance} руб.")
 
+    owner = uuid.uuid4().hex  # владелец записей журнала заказов этой проверки
     checked = 0
-    updated = 0
+    updated = resume_pending_orders(user_id)  # заказы, брошенные прошлым запуском
     ok_pages = []
+    interrupted = False
+    bump_daily_stats(cursor, user_id, checks=1)
+    conn.commit()  # не держим запись в БД открытой на время запросов к VK
 
     # Проверяем каждый аккаунт
+    # Паузу между запросами к VK (лимит на токен) выдерживает REQUEST_SCHEDULER
     for acc_id, vk_input, owner_id, vk_token, last_post_id in accounts:
-        time.sleep(0.4)  # Пауза между запросами к VK API (чтобы не превышать лимит)
+        if SHUTTING_DOWN.is_set():
+            interrupted = True
+            break
 
-        post_url, post_id, skip_send, err = get_last_vk_post(owner_id, vk_token)
+        page = []
+        post_url, post_id, skip_send, err = get_last_vk_post(owner_id, vk_token, page)
 
-        if err or post_url is None:
+        if err:
+            bump_daily_stats(cursor, user_id, vk_errors=1)
+            conn.commit()
+            continue
+        if post_url is None:
             continue
 
         checked += 1
+        record_wall_page(cursor, acc_id, user_id, owner_id, page)
 
-        if post_id != last_post_id:
-            # 1) Всегда обновляем БД (даже если skip_send=True)
+        if is_newer_post(post_id, last_post_id):
+            # 1) Всегда обновляем БД (даже если skip_send=True).
+            #    Условие на старый last_post_id — это compare-and-set: если пост
+            #    уже забрала параллельная проверка, rowcount будет 0.
             cursor.execute(
-                "UPDATE vk_accounts SET last_post_url=?, last_post_id=? WHERE id=?",
-                (post_url, post_id, acc_id)
+                "UPDATE vk_accounts SET last_post_url=?, last_post_id=? WHERE id=? AND last_post_id IS ?",
+                (post_url, post_id, acc_id, last_post_id)
             )
+            claimed = cursor.rowcount == 1
+            if claimed and not skip_send:
+                # В той же транзакции — запись в журнал: заказ не потеряется при остановке
+                cursor.execute(
+                    "INSERT OR IGNORE INTO pending_orders "
+                    "(account_id, user_id, post_id, post_url, owner, lease_until) VALUES (?, ?, ?, ?, ?, ?)",
+                    (acc_id, user_id, post_id, post_url, owner, time.time() + PENDING_ORDER_LEASE)
+                )
             conn.commit()
 
+            if not claimed:
+                continue
+
             # 2) Если репостов 1+ — НЕ отправляем в smmlaba
             if skip_send:
+                mark_post_result(cursor, acc_id, post_id, False, "reposts")
+                bump_daily_stats(cursor, user_id, skipped_reposts=1)
+                conn.commit()
                 continue
 
-            # 3) Иначе отправляем
+            # 3) Иначе отправляем — если запись журнала всё ещё наша (и убираем её
+            #    в одной транзакции с результатом)
+            if not claim_pending_order(cursor, acc_id, post_id, owner):
+                conn.commit()
+                continue
+            conn.commit()
             success, msg_text = send_to_smmlaba(post_url, email, api_key)
+            finish_pending_order(cursor, acc_id, post_id, owner)
             if success:
                 updated += 1
                 ok_pages.append(vk_input)
+                mark_post_result(cursor, acc_id, post_id, True)
+                bump_daily_stats(cursor, user_id, orders=1, likes_ordered=SMMLABA_COUNT)
+            else:
+                mark_post_result(cursor, acc_id, post_id, False, "send_error")
+                bump_daily_stats(cursor, user_id, send_errors=1)
+
+        conn.commit()
 
     conn.close()
 
@@ -815,7 +2221,167 @@ async def check_posts(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         result += "\n📌 Новых постов не найдено"
 
-    await msg.edit_text(result)
+    if interrupted:
+        result += "\n\n⚠️ Бот перезапускается — проверка прервана, остальные аккаунты проверятся после запуска"
+
+    return result
+
+
+def _forget_check(user_id: int, task):
+    if _inflight_checks.get(user_id) is task:
+        del _inflight_checks[user_id]
+
+
+async def check_posts(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Проверяет все ВК-аккаунты на новые посты и загружает их на smmlaba"""
+    user_id = update.effective_user.id
+
+    task = _inflight_checks.get(user_id)
+    if task is None and SHUTTING_DOWN.is_set():
+        await update.message.reply_text("🔄 Бот перезапускается, попробуйте через минуту.")
+        return
+
+    # Трейс пишет только тот, кто запускает проверку; присоединившийся запрос — нет
+    with trace_span("check_posts", root=task is None, user_id=user_id):
+        if task is None:
+            # Регистрируем проверку до первого await — повторный /check, пришедший,
+            # пока мы отвечаем в чат, уже застанет её и присоединится.
+            # create_task копирует контекст — отрезки из потока попадут в этот трейс
+            task = asyncio.create_task(asyncio.to_thread(run_check, user_id))
+            _inflight_checks[user_id] = task
+            task.add_done_callback(lambda t: _forget_check(user_id, t))
+            with trace_span("telegram.reply_text"):
+                msg = await update.message.reply_text("⏳ Проверяю посты...")
+        else:
+            msg = await update.message.reply_text("⏳ Проверка уже идёт — пришлю её результат...")
+
+        # shield: если этот обработчик отменят, общая проверка всё равно доживёт до конца
+        result = await asyncio.shield(task)
+        with trace_span("telegram.edit_text"):
+            await msg.edit_text(result)
+
+
+# ========== КОМАНДЫ АДМИНИСТРАТОРА ==========
+
+def is_admin(user_id: int):
+    return user_id in ADMIN_IDS
+
+
+async def trace_last(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Последние трейсы проверок.
+    Формат: /trace_last [N] — сводка по последнему трейсу и JSON последних N
+    """
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ Команда доступна только администратору.")
+        return
+
+    if not _traces:
+        await update.message.reply_text("📭 Трейсов пока нет — запустите /check")
+        return
+
+    count = 1
+    if context.args and context.args[0].isdigit():
+        count = max(1, min(int(context.args[0]), TRACE_BUFFER_SIZE))
+
+    last = _traces[-1]
+    text = (
+        f"🔎 Последний трейс: {last.name} {last.attrs}\n"
+        f"⏱️ Всего: {last.duration * 1000:.0f} мс\n\n"
+    )
+    for name, n, total in sorted(summarize_trace(last), key=lambda x: -x[2]):
+        text += f"• {name}: {n} шт, {total * 1000:.0f} мс\n"
+
+    await update.message.reply_text(text)
+    await update.message.reply_document(
+        document=io.BytesIO(export_traces(count).encode("utf-8")),
+        filename="traces.json",
+    )
+
+
+async def metrics_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Метрики очередей запросов к VK/smmlaba по полосам"""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ Команда доступна только администратору.")
+        return
+
+    m = REQUEST_SCHEDULER.metrics()
+    text = (
+        f"🔑 Пул токенов чтения: {len(READ_TOKEN_POOL)} шт, выдано {READ_TOKEN_POOL.picks}, "
+        f"выброшено {READ_TOKEN_POOL.evictions}\n\n"
+        f"📦 Ответы API (облегчённое чтение стен: {'вкл' if VK_LEAN_FETCH else 'выкл'}):\n"
+    )
+    with _payload_lock:
+        payload = {key: list(st) for key, st in PAYLOAD_STATS.items()}
+    for key, (n, nbytes, parse_s) in sorted(payload.items()):
+        text += f"• {key}: {n} шт, ср {nbytes / n / 1024:.1f} КБ, разбор ср {parse_s / n * 1000:.2f} мс\n"
+
+    text += "\n⏱️ Задержки (p50 / p95 / p99 → таймаут):\n"
+    for key in sorted(LATENCY.snapshot()):
+        p50, p95, p99 = (LATENCY.percentile(key, q) for q in (0.5, 0.95, 0.99))
+        if p50 is None:
+            text += f"• {key}: мало замеров\n"
+            continue
+        ceiling = SMMLABA_TIMEOUT if key.startswith("smmlaba:") else VK_TIMEOUT
+        text += (
+            f"• {key}: {p50 * 1000:.0f} / {p95 * 1000:.0f} / {p99 * 1000:.0f} мс → "
+            f"{LATENCY.timeout_for(key, ceiling):.1f} с\n"
+        )
+    text += (
+        f"🛟 Страховочные запросы: отправлено {HEDGE_BUDGET.sent}, выиграли {HEDGE_BUDGET.won}, "
+        f"без бюджета/слота {HEDGE_BUDGET.denied}\n"
+    )
+
+    text += f"\n📈 Очереди запросов (лимитов: {m['budgets']})\n\n"
+    for lane in LANE_WEIGHTS:
+        st = m[lane]
+        text += (
+            f"• {lane} (вес {LANE_WEIGHTS[lane]}): в очереди {st['depth']} (макс {st['max_depth']}), "
+            f"выдано {st['granted']}, ожидание ср {st['wait_avg'] * 1000:.0f} мс / "
+            f"макс {st['wait_max'] * 1000:.0f} мс, вне очереди {st['starved']}\n"
+        )
+
+    await update.message.reply_text(text)
+
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Включает сэмплирующий профайлер на заданное окно.
+    Формат: /profile 60s — по окончании пришлёт collapsed stacks для flamegraph
+    """
+    global _profiler
+
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ Команда доступна только администратору.")
+        return
+
+    arg = (context.args[0] if context.args else "60s").lower().rstrip("s")
+    if not arg.isdigit() or not 0 < int(arg) <= PROFILE_MAX_SECONDS:
+        await update.message.reply_text(f"❌ Используйте: /profile 60s (от 1 до {PROFILE_MAX_SECONDS} секунд)")
+        return
+
+    if _profiler is not None:
+        await update.message.reply_text("⏳ Профайлер уже запущен, дождитесь результата.")
+        return
+
+    seconds = int(arg)
+    _profiler = SamplingProfiler()
+    _profiler.start()
+    await update.message.reply_text(f"🔬 Профайлер запущен на {seconds} с...")
+
+    async def finish():
+        global _profiler
+        await asyncio.sleep(seconds)
+        profiler, _profiler = _profiler, None
+        dump = await asyncio.to_thread(profiler.stop)
+        await update.message.reply_document(
+            document=io.BytesIO(dump.encode("utf-8")),
+            filename=f"profile_{int(profiler.started_at)}.folded",
+            caption=f"🔬 {sum(profiler.samples.values())} сэмплов за {seconds} с (flamegraph.pl / speedscope)",
+        )
+
+    # Не держим обработчик окно целиком — иначе встанут остальные апдейты
+    context.application.create_task(finish())
 
 
 # ========== ОБРАБОТКА СООБЩЕНИЙ ==========
@@ -855,15 +2421,15 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif text == "🏠 Назад":
         await start(update, context)
     elif text == "🗑️ Удалить аккаунт":
-    await update.message.reply_text(
-        "🗑️ УДАЛИТЬ ВК АККАУНТ\\n\\n"
-        "Используйте команду:\\n"
-        "/delete_vk VK_ID\\n\\n"
-        "Примеры:\\n"
-        "/delete_vk id123456789\\n"
-        "/delete_vk club12345678\\n\\n"
-        "Используйте /list чтобы посмотреть все ваши аккаунты"
-    )
+        await update.message.reply_text(
+            "🗑️ УДАЛИТЬ ВК АККАУНТ\\n\\n"
+            "Используйте команду:\\n"
+            "/delete_vk VK_ID\\n\\n"
+            "Примеры:\\n"
+            "/delete_vk id123456789\\n"
+            "/delete_vk club12345678\\n\\n"
+            "Используйте /list чтобы посмотреть все ваши аккаунты"
+        )
     else:
         await update.message.reply_text(
             "👋 Пожалуйста, используйте кнопки меню или команды.",
@@ -871,13 +2437,264 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
 
+# ========== ПАРАЛЛЕЛЬНАЯ ОБРАБОТКА АПДЕЙТОВ ==========
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Апдейты разных пользователей обрабатываются параллельно (до max_concurrent_updates),
+    апдейты одного пользователя — строго по очереди (asyncio.Lock честный, FIFO),
+    так что /add_vk, а следом /check, отработают в правильном порядке.
+    /check (и кнопка проверки) дожидается своей очереди, но блокировку на время
+    проверки не держит — повторное нажатие присоединяется к идущей проверке
+    (см. check_posts), а не запускает вторую после неё.
+
+    Если обработчик думает дольше BUSY_AFTER — в чате висит "печатает...",
+    дольше HANDLER_TIMEOUT — обработчик прерывается с сообщением пользователю.
+
+    Семафор базового класса PTB берётся ещё до do_process_update, то есть до
+    блокировки пользователя: апдейты, ждущие своей очереди, держали бы слоты, и
+    один пользователь, нажавший кнопку много раз, занял бы их все. Поэтому у
+    базового класса лимита нет (sys.maxsize), а свой семафор берём уже после
+    блокировки пользователя — слот занимает только тот, кто реально работает.
+    """
+
+    __slots__ = ("_user_locks", "_slots", "limit", "handled", "timed_out")
+
+    def __init__(self, max_concurrent_updates: int):
+        if max_concurrent_updates < 1:
+            raise ValueError("max_concurrent_updates должно быть положительным")
+        super().__init__(sys.maxsize)
+        self.limit = max_concurrent_updates
+        self._slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self._user_locks = {}  # user_id -> [asyncio.Lock, сколько апдейтов его ждут]
+        self.handled = 0
+        self.timed_out = 0
+
+    async def do_process_update(self, update, coroutine):
+        user = getattr(update, "effective_user", None)
+        if user is None:
+            async with self._slots:
+                await coroutine
+            return
+
+        entry = self._user_locks.get(user.id)
+        if entry is None:
+            entry = self._user_locks[user.id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            if self._is_check(update):
+                async with entry[0]:
+                    pass  # только дождаться своей очереди
+                if user.id in _inflight_checks:
+                    # Присоединяется к идущей проверке и лишь ждёт её результат — слот не нужен
+                    await self._run_with_timeout(update, coroutine)
+                else:
+                    async with self._slots:
+                        await self._run_with_timeout(update, coroutine)
+            else:
+                async with entry[0], self._slots:
+                    await self._run_with_timeout(update, coroutine)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._user_locks[user.id]
+
+    @staticmethod
+    def _is_check(update):
+        """Апдейт — /check или кнопка «✅ Проверить все посты»"""
+        message = getattr(update, "message", None)
+        text = (getattr(message, "text", None) or "").strip()
+        if text == "✅ Проверить все посты":
+            return True
+        command = text.split(maxsplit=1)[0] if text else ""
+        return command.split("@", 1)[0] == "/check"
+
+    async def _run_with_timeout(self, update, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        busy = asyncio.create_task(self._show_busy(update, task))
+        try:
+            await asyncio.wait_for(task, HANDLER_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.timed_out += 1
+            chat = getattr(update, "effective_chat", None)
+            if chat is not None:
+                await chat.send_message(
+                    "⌛ Команда выполнялась слишком долго и была прервана.\n"
+                    "Попробуйте ещё раз чуть позже."
+                )
+        finally:
+            busy.cancel()
+            self.handled += 1
+
+    @staticmethod
+    async def _show_busy(update, task):
+        """Пока обработчик работает — раз в 4 секунды шлём "печатает..." (индикатор живёт 5 с)"""
+        chat = getattr(update, "effective_chat", None)
+        if chat is None:
+            return
+        await asyncio.sleep(BUSY_AFTER)
+        while not task.done():
+            try:
+                await chat.send_action(ChatAction.TYPING)
+            except Exception:
+                pass
+            await asyncio.sleep(4)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+# ========== ОСТАНОВКА И ТЁПЛЫЙ ПЕРЕЗАПУСК ==========
+
+def save_checkpoint(path: str = CHECKPOINT_PATH):
+    """
+    Сохраняет состояние, которое дорого набирать заново:
+    окна задержек (адаптивные таймауты), закрытые стены и выброшенные токены пула.
+    Пишем во временный файл и переименовываем — файл не бывает записан наполовину.
+    """
+    state = {
+        "saved_at": time.time(),
+        "latency": LATENCY.snapshot(),
+        "read_pool": READ_TOKEN_POOL.snapshot(),
+        "hedge_tokens": HEDGE_BUDGET.tokens,
+    }
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+    return state
+
+
+def load_checkpoint(path: str = CHECKPOINT_PATH):
+    """
+    Поднимает состояние из чекпоинта (если он есть). Вызывать после READ_TOKEN_POOL.load():
+    выброшенные токены убираются из уже заполненного пула.
+    """
+    try:
+        with open(path, encoding="utf-8") as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return False
+    except (OSError, ValueError) as e:
+        print(f"⚠️ Чекпоинт {path} не прочитан: {e}")
+        return False
+
+    LATENCY.restore(state.get("latency", {}))
+    READ_TOKEN_POOL.restore(state.get("read_pool", {}))
+    HEDGE_BUDGET.tokens = min(HEDGE_BUDGET.burst, state.get("hedge_tokens", 0.0))
+    age = time.time() - state.get("saved_at", time.time())
+    print(f"♻️ Чекпоинт ({age:.0f} с назад): задержки {len(state.get('latency', {}))} эндпоинтов, "
+          f"закрытых стен {len(state.get('read_pool', {}).get('private_walls', {}))}")
+    return True
+
+
+# Фоновые задачи, созданные из обработчиков сигналов и post_init: без ссылки
+# на задачу её может собрать сборщик мусора посреди работы
+_background_tasks = set()
+_drain_result = None  # сколько проверок не дождались при остановке по сигналу (None — ещё не ждали)
+
+
+def _spawn(coro):
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+async def drain_checks(timeout: float = SHUTDOWN_DRAIN_SECONDS):
+    """Ждёт завершения идущих проверок; возвращает, сколько так и не успело"""
+    tasks = list(_inflight_checks.values())
+    if not tasks:
+        return 0
+    print(f"⏳ Дожидаюсь {len(tasks)} проверок (до {timeout} с)...")
+    _, pending = await asyncio.wait(tasks, timeout=timeout)
+    return len(pending)
+
+
+async def graceful_shutdown(app: Application):
+    """
+    Мягкая остановка по SIGTERM/SIGINT: новые проверки не принимаем, идущие
+    дорабатывают текущий аккаунт и отдают результат пользователю (не дольше
+    SHUTDOWN_DRAIN_SECONDS), затем бот останавливается.
+    """
+    global _drain_result
+    SHUTTING_DOWN.set()
+    print("🛑 Получен сигнал остановки (повторный сигнал — выход сразу)")
+    _drain_result = await drain_checks()
+    if _drain_result:
+        print(f"⚠️ Не дождались {_drain_result} проверок — незаказанные посты остались в журнале")
+    app.stop_running()
+
+
+def on_signal(app: Application, sig: int):
+    """
+    Первый сигнал — мягкая остановка. Второй — немедленный выход: заказы
+    в работе дошлёт журнал (аренда истечёт), записи в БД уже закоммичены по шагам.
+    """
+    if not SHUTTING_DOWN.is_set():
+        _spawn(graceful_shutdown(app))
+        return
+    print("⛔ Повторный сигнал — выходим, не дожидаясь проверок")
+    try:
+        save_checkpoint()
+    except OSError as e:
+        print(f"⚠️ Чекпоинт не сохранён: {e}")
+    sys.stdout.flush()
+    os._exit(128 + sig)
+
+
+async def on_startup(app: Application):
+    """post_init: сигналы мягкой остановки и досылка заказов, прерванных прошлым запуском"""
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, on_signal, app, sig)
+        except (NotImplementedError, RuntimeError):
+            # Windows / не главный поток: остаётся обычная остановка по Ctrl+C
+            pass
+
+    async def resume():
+        sent = await asyncio.to_thread(resume_pending_orders)
+        if sent:
+            print(f"📨 Досланы заказы после перезапуска: {sent}")
+
+    _spawn(resume())
+
+
+async def on_stop(app: Application):
+    """post_stop: дожидаемся проверок (если остановка пришла не через сигнал — там уже ждали) и пишем чекпоинт"""
+    SHUTTING_DOWN.set()
+    left = _drain_result if _drain_result is not None else await drain_checks()
+    save_checkpoint()
+    if not left:
+        # Не дождавшаяся проверка ещё работает в потоке — пул страховок ей нужен
+        _hedge_pool.shutdown(wait=False)
+    print(f"💾 Чекпоинт сохранён: {CHECKPOINT_PATH}")
+
+
 # ========== ГЛАВНАЯ ФУНКЦИЯ ==========
 
 def main():
     """Инициализирует и запускает бота"""
+    if not TELEGRAM_TOKEN:
+        print("❌ Ошибка: TELEGRAM_TOKEN не найден!")
+        exit(1)
+
     init_database()
-    
-    app = Application.builder().token(TELEGRAM_TOKEN).build()
+    print(f"🔑 Токенов в пуле чтения: {READ_TOKEN_POOL.load()}")
+    load_checkpoint()
+
+    app = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .concurrent_updates(PerUserUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        .post_init(on_startup)
+        .post_stop(on_stop)
+        .build()
+    )
 
     # Команды
     app.add_handler(CommandHandler("start", start))
@@ -888,14 +2705,41 @@ def main():
     app.add_handler(CommandHandler("delete_vk", delete_vk_account))
     app.add_handler(CommandHandler("list", list_accounts))
     app.add_handler(CommandHandler("check", check_posts))
+    app.add_handler(CommandHandler("stats", show_stats))
+    app.add_handler(CommandHandler("trace_last", trace_last))
+    app.add_handler(CommandHandler("profile", profile_command))
+    app.add_handler(CommandHandler("metrics", metrics_command))
 
     # Обработчик текстовых сообщений (кнопки)
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler))
 
     print("🚀 Бот запущен!")
     print("📌 Нажмите Ctrl+C для остановки")
-    app.run_polling(allowed_updates=Update.ALL_TYPES)
+    # Сигналы обрабатывает on_startup: сначала дожидаемся проверок, потом останавливаемся
+    app.run_polling(allowed_updates=Update.ALL_TYPES, stop_signals=None)
+
+
+def cli():
+    """Разбор аргументов командной строки: без аргументов — запуск бота"""
+    parser = argparse.ArgumentParser(description="Telegram-бот: посты ВК → smmlaba")
+    parser.add_argument("--record", metavar="CASSETTE",
+                        help="записать кассету: одна живая проверка пользователя --user")
+    parser.add_argument("--replay", metavar="CASSETTE",
+                        help="регресс-тест: проверка на кассете, код выхода 1 при регрессии")
+    parser.add_argument("--user", type=int, help="Telegram ID пользователя для --record")
+    parser.add_argument("--scale", type=float, default=1.0, help="множитель задержек при --replay")
+    parser.add_argument("--max-slowdown", type=float, default=1.2, help="допустимое замедление при --replay")
+    args = parser.parse_args()
+
+    if args.record:
+        if args.user is None:
+            parser.error("--record требует --user")
+        record_workload(args.record, args.user)
+    elif args.replay:
+        sys.exit(0 if replay_workload(args.replay, args.scale, args.max_slowdown) else 1)
+    else:
+        main()
 
 
 if __name__ == "__main__":
-    main()
+    cli()
@@ -0,0 +1,66 @@
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot_vkapi as bot  # noqa: E402
+
+OWNER_ID = -5  # сообщество — читается через пул
+
+
+class FakeResponse:
+    def __init__(self, data):
+        self.content = json.dumps(data).encode()
+        self.encoding = None
+
+    def json(self):
+        return json.loads(self.content)
+
+
+@pytest.fixture
+def vk(monkeypatch):
+    """Подменяет HTTP к VK: стена закрыта для всех, кроме токена OWN; возвращает журнал запросов"""
+    monkeypatch.setattr(bot, "REQUEST_SCHEDULER", bot.RequestScheduler())
+    monkeypatch.setattr(bot, "LATENCY", bot.LatencyTracker())
+    monkeypatch.setattr(bot, "HEDGE_BUDGET", bot.HedgeBudget())
+    monkeypatch.setattr(bot, "VK_MIN_INTERVAL", 0.0)
+    requests_made = []
+
+    def get(url, params=None, timeout=None):
+        method = url.rsplit("/", 1)[-1]
+        requests_made.append((method, params["access_token"]))
+        if params["access_token"] == "OWN":
+            return FakeResponse({"response": {"count": 1, "id": [3], "date": [1], "reposts": [{"count": 0}]}})
+        error = {"error_code": 15, "error_msg": "Access denied: this wall available only for community members"}
+        if method == "execute":
+            return FakeResponse({"response": False, "execute_errors": [dict(error, method="wall.get")]})
+        return FakeResponse({"error": error})
+
+    monkeypatch.setattr(bot.requests, "get", get)
+    return requests_made
+
+
+def test_inner_error_is_returned_without_refetch(vk):
+    """Ошибка wall.get внутри execute возвращается сразу — без повторного чтения обычным wall.get"""
+    resp, err = bot.fetch_wall_page(OWNER_ID, "POOL")
+
+    assert resp is None
+    assert err["error_code"] == 15
+    assert vk == [("execute", "POOL")]
+
+
+def test_closed_wall_via_pool_costs_two_requests(vk, monkeypatch):
+    """Токен пула не видит стену — она помечается закрытой, и читает токен аккаунта"""
+    pool = bot.ReadTokenPool()
+    pool.add("POOL")
+    monkeypatch.setattr(bot, "READ_TOKEN_POOL", pool)
+
+    post_url, post_id, skip_send, error = bot.get_last_vk_post(OWNER_ID, "OWN")
+
+    assert error is None
+    assert post_id == "3"
+    assert vk == [("execute", "POOL"), ("execute", "OWN")]
+    assert pool.is_private(OWNER_ID)
@@ -0,0 +1,53 @@
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot_vkapi as bot  # noqa: E402
+
+KEY = "vk:wall.get"
+
+
+@pytest.fixture
+def warm(monkeypatch):
+    """Окно задержек заполнено (p95 = 50 мс), лимиты API не мешают"""
+    latency = bot.LatencyTracker()
+    for _ in range(bot.LATENCY_MIN_SAMPLES):
+        latency.observe(KEY, 0.05)
+    monkeypatch.setattr(bot, "LATENCY", latency)
+    monkeypatch.setattr(bot, "HEDGE_BUDGET", bot.HedgeBudget())
+    monkeypatch.setattr(bot, "REQUEST_SCHEDULER", bot.RequestScheduler())
+
+
+def test_without_budget_runs_in_calling_thread(warm):
+    """Нет жетона на страховку — запрос не идёт в пул потоков"""
+    threads = []
+
+    def do_request():
+        threads.append(threading.get_ident())
+        return {"ok": 1}, None
+
+    assert bot.hedged_request(KEY, do_request, "budget", 0.0) == ({"ok": 1}, None)
+    assert threads == [threading.get_ident()]
+
+
+def test_prefers_first_successful_result(warm):
+    """Основной запрос быстрее, но с ошибкой — берём успешный ответ страховки"""
+    bot.HEDGE_BUDGET.tokens = bot.HEDGE_BUDGET.burst
+    calls = []
+
+    def do_request():
+        calls.append(1)
+        first = len(calls) == 1
+        time.sleep(0.1)
+        if first:
+            return None, {"error_msg": "timeout"}
+        time.sleep(0.05)
+        return {"ok": 1}, None
+
+    assert bot.hedged_request(KEY, do_request, "budget", 0.0) == ({"ok": 1}, None)
+    assert bot.HEDGE_BUDGET.won == 1
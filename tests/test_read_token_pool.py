@@ -0,0 +1,29 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot_vkapi as bot  # noqa: E402
+
+
+def test_pick_skips_token_busy_in_scheduler(monkeypatch):
+    """Токен, лимит которого занят своим трафиком (не через пул), пул не выдаёт"""
+    monkeypatch.setattr(bot, "REQUEST_SCHEDULER", bot.RequestScheduler())
+    pool = bot.ReadTokenPool()
+    pool.add("A")
+    pool.add("B")
+
+    bot.REQUEST_SCHEDULER.acquire(bot.vk_budget_key("A"), 1.0)
+
+    assert pool.pick() == "B"
+
+
+def test_expired_private_walls_are_pruned(monkeypatch):
+    monkeypatch.setattr(bot, "PRIVATE_WALL_RECHECK", 0.05)
+    pool = bot.ReadTokenPool()
+    pool.mark_private(-1)
+    time.sleep(0.1)
+    pool.mark_private(-2)
+
+    assert pool.snapshot()["private_walls"].keys() == {"-2"}
@@ -0,0 +1,151 @@
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot_vkapi as bot  # noqa: E402
+
+USER_ID = 1
+OWNER_ID = 7  # стена пользователя — читается токеном аккаунта, без пула
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """Пустая БД во временной папке: учётные данные smmlaba и один ВК-аккаунт с last_post_id=10"""
+    monkeypatch.setattr(bot, "DB_PATH", str(tmp_path / "vk_posts.db"))
+    monkeypatch.setattr(bot, "check_smmlaba_balance", lambda email, api_key: (100.0, None))
+    bot.init_database()
+
+    conn = bot.db_connect()
+    conn.execute(
+        "INSERT INTO user_smmlaba_credentials (user_id, email, api_key) VALUES (?, ?, ?)",
+        (USER_ID, "a@b.c", "KEY"),
+    )
+    conn.execute(
+        "INSERT INTO vk_accounts (user_id, vk_input, owner_id, vk_token, last_post_url, last_post_id) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        (USER_ID, "id7", OWNER_ID, "TOK", f"https://vk.com/wall{OWNER_ID}_10", "10"),
+    )
+    conn.commit()
+    conn.close()
+    yield
+
+
+def wall_with(post_id, before_return=None):
+    """Заглушка fetch_wall_page: на стене один пост post_id"""
+    def fetch_wall_page(owner_id, access_token):
+        if before_return is not None:
+            before_return()
+        return {"count": 1, "items": [{"id": post_id, "date": 1, "reposts": {"count": 0}}]}, None
+    return fetch_wall_page
+
+
+def record_orders(monkeypatch, on_send=None):
+    """Подменяет send_to_smmlaba; возвращает список отправленных post_url"""
+    orders = []
+
+    def send_to_smmlaba(post_url, email, api_key):
+        orders.append(post_url)
+        if on_send is not None:
+            on_send()
+        return True, "ok"
+
+    monkeypatch.setattr(bot, "send_to_smmlaba", send_to_smmlaba)
+    return orders
+
+
+def last_post_id():
+    conn = bot.db_connect()
+    value = conn.execute("SELECT last_post_id FROM vk_accounts").fetchone()[0]
+    conn.close()
+    return value
+
+
+def test_concurrent_checks_order_new_post_once(db, monkeypatch):
+    """Две проверки одновременно видят новый пост — заказ уходит один раз"""
+    both_read = threading.Barrier(2, timeout=5)
+    monkeypatch.setattr(bot, "fetch_wall_page", wall_with(11, before_return=both_read.wait))
+    orders = record_orders(monkeypatch)
+
+    threads = [threading.Thread(target=bot.run_check, args=(USER_ID,)) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+
+    assert orders == [f"https://vk.com/wall{OWNER_ID}_11"]
+    assert last_post_id() == "11"
+
+
+def test_check_started_during_send_does_not_resend(db, monkeypatch):
+    """Проверка, начатая, пока первая ещё отправляет заказ, не досылает его из журнала"""
+    sending = threading.Event()
+    release = threading.Event()
+
+    def hold_send():
+        sending.set()
+        release.wait(5)
+
+    monkeypatch.setattr(bot, "fetch_wall_page", wall_with(11))
+    orders = record_orders(monkeypatch, on_send=hold_send)
+
+    first = threading.Thread(target=bot.run_check, args=(USER_ID,))
+    first.start()
+    assert sending.wait(5)
+    bot.run_check(USER_ID)
+    release.set()
+    first.join(10)
+
+    assert orders == [f"https://vk.com/wall{OWNER_ID}_11"]
+
+
+def test_cursor_going_backwards_does_not_order(db, monkeypatch):
+    """Стена вернула пост старше сохранённого курсора — заказа нет, курсор не откатывается"""
+    monkeypatch.setattr(bot, "fetch_wall_page", wall_with(9))
+    orders = record_orders(monkeypatch)
+
+    bot.run_check(USER_ID)
+
+    assert orders == []
+    assert last_post_id() == "10"
+
+
+def test_abandoned_journal_entry_is_resumed_once(db, monkeypatch):
+    """Запись журнала с истёкшей арендой досылается ровно один раз; живая — не трогается"""
+    orders = record_orders(monkeypatch)
+    conn = bot.db_connect()
+    acc_id = conn.execute("SELECT id FROM vk_accounts").fetchone()[0]
+    for post_id, lease_until in (("8", time.time() - 1), ("9", time.time() + 60)):
+        conn.execute(
+            "INSERT INTO pending_orders (account_id, user_id, post_id, post_url, owner, lease_until) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (acc_id, USER_ID, post_id, f"https://vk.com/wall{OWNER_ID}_{post_id}", "other", lease_until),
+        )
+    conn.commit()
+    conn.close()
+
+    assert bot.resume_pending_orders() == 1
+    assert bot.resume_pending_orders() == 0
+    assert orders == [f"https://vk.com/wall{OWNER_ID}_8"]
+
+
+def test_journal_entry_of_deleted_account_is_not_resumed(db, monkeypatch):
+    """Аккаунт удалили — брошенная запись журнала заказ уже не создаёт"""
+    orders = record_orders(monkeypatch)
+    conn = bot.db_connect()
+    acc_id = conn.execute("SELECT id FROM vk_accounts").fetchone()[0]
+    conn.execute(
+        "INSERT INTO pending_orders (account_id, user_id, post_id, post_url, owner, lease_until) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        (acc_id, USER_ID, "11", f"https://vk.com/wall{OWNER_ID}_11", "other", time.time() - 1),
+    )
+    conn.execute("DELETE FROM vk_accounts WHERE id=?", (acc_id,))
+    conn.commit()
+    conn.close()
+
+    assert bot.resume_pending_orders() == 0
+    assert orders == []
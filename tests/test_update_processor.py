@@ -0,0 +1,107 @@
+import asyncio
+import collections
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot_vkapi as bot  # noqa: E402
+
+LIMIT = 4
+
+
+class FakeUser:
+    def __init__(self, user_id):
+        self.id = user_id
+
+
+class FakeMessage:
+    def __init__(self, text=None):
+        self.text = text
+
+    async def reply_text(self, text, **kwargs):
+        return FakeMessage(text)
+
+    async def edit_text(self, text, **kwargs):
+        self.text = text
+        return self
+
+
+class FakeUpdate:
+    """Апдейт без Telegram: только поля, которые читают процессор и check_posts"""
+    effective_chat = None
+
+    def __init__(self, user_id, seq=0, text=None):
+        self.effective_user = FakeUser(user_id)
+        self.message = FakeMessage(text)
+        self.seq = seq
+
+
+def test_users_run_in_parallel_and_each_user_stays_ordered():
+    """Разные пользователи — параллельно (до лимита), апдейты одного — строго по порядку"""
+    users, per_user, delay = 10, 3, 0.05
+    seen = collections.defaultdict(list)
+
+    async def handler(update):
+        await asyncio.sleep(delay)
+        seen[update.effective_user.id].append(update.seq)
+
+    async def run():
+        processor = bot.PerUserUpdateProcessor(LIMIT)
+        updates = [FakeUpdate(u, seq) for seq in range(per_user) for u in range(users)]
+        async with processor:
+            await asyncio.gather(*(processor.process_update(upd, handler(upd)) for upd in updates))
+
+    started = time.perf_counter()
+    asyncio.run(run())
+    elapsed = time.perf_counter() - started
+
+    assert all(seqs == list(range(per_user)) for seqs in seen.values())
+    assert len(seen) == users
+    assert elapsed < users * per_user * delay / 2
+
+
+def test_one_users_burst_does_not_block_others():
+    """Очередь одного пользователя не занимает слоты: остальные не ждут её разбора"""
+    burst, delay = LIMIT + 2, 0.3
+    waited = []
+
+    async def run():
+        processor = bot.PerUserUpdateProcessor(LIMIT)
+
+        async def timed(update):
+            started = time.perf_counter()
+            await processor.process_update(update, asyncio.sleep(0.01))
+            waited.append(time.perf_counter() - started)
+
+        async with processor:
+            hot = [processor.process_update(FakeUpdate(0, seq), asyncio.sleep(delay)) for seq in range(burst)]
+            quick = [timed(FakeUpdate(u)) for u in range(1, 6)]
+            await asyncio.gather(*hot, *quick)
+
+    asyncio.run(run())
+
+    assert max(waited) < delay
+
+
+def test_repeated_check_taps_start_one_check(monkeypatch):
+    """/check, кнопка и /check@bot подряд — одна проверка, остальные ждут её результат"""
+    runs = []
+
+    def run_check(user_id):
+        runs.append(user_id)
+        time.sleep(0.2)
+        return "✅ Проверка завершена!"
+
+    monkeypatch.setattr(bot, "run_check", run_check)
+    updates = [FakeUpdate(1, seq, text) for seq, text in enumerate(["/check", "✅ Проверить все посты", "/check@bot"])]
+
+    async def run():
+        processor = bot.PerUserUpdateProcessor(LIMIT)
+        async with processor:
+            await asyncio.gather(*(processor.process_update(upd, bot.check_posts(upd, None)) for upd in updates))
+
+    asyncio.run(run())
+
+    assert runs == [1]